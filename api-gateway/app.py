@@ -2,249 +2,568 @@
 API Gateway - Central entry point for DevMateriels microservices.
 Routes requests to appropriate backend services.
 """
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from flask import Flask, request, jsonify, Response, g
+from flask.json.provider import JSONProvider
+import orjson
+import ormsgpack
 import requests
+from requests.adapters import HTTPAdapter
+import pybreaker
 import os
+import sys
+import queue
+import socket
+import time
+import atexit
+import threading
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from pythonjsonlogger.json import JsonFormatter
+from urllib.parse import urlsplit
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FutureTimeout, wait
+from functools import partial
+
+from cache import cached, invalidate, ping as ping_cache
+from metrics import UPSTREAM_LATENCY, metrics_response
+
+
+
+def configure_logging():
+    """
+    Send log records through a queue to a background listener writing JSON
+    lines to stdout, so request handlers never block on log output.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter(
+        '%(asctime)s %(levelname)s %(name)s %(message)s',
+        static_fields={'service': 'api-gateway'},
+        json_ensure_ascii=False
+    ))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    # Per-request access lines from the dev server are not needed
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    listener.start()
+    atexit.register(listener.stop)
+
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+
 app = Flask(__name__)
-CORS(app)
+app.json = OrjsonProvider(app)
 
 # Service URLs from environment
 PLANNING_SERVICE_URL = os.getenv('PLANNING_SERVICE_URL', 'http://localhost:5001')
 DEVIS_SERVICE_URL = os.getenv('DEVIS_SERVICE_URL', 'http://localhost:5002')
 NOTIFICATION_SERVICE_URL = os.getenv('NOTIFICATION_SERVICE_URL', 'http://localhost:5003')
+SERVICE_URLS = (PLANNING_SERVICE_URL, DEVIS_SERVICE_URL, NOTIFICATION_SERVICE_URL)
+SERVICE_NAMES = {
+    PLANNING_SERVICE_URL: 'planning',
+    DEVIS_SERVICE_URL: 'devis',
+    NOTIFICATION_SERVICE_URL: 'notification'
+}
+
+STREAM_CHUNK_SIZE = 64 * 1024
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Keep-alive connections per backend service. Requests wait for a free
+# connection instead of opening throwaway sockets past this limit.
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '100'))
+
+# Ask backends for msgpack bodies; the gateway transcodes them to JSON for
+# clients. Backends that only speak JSON keep answering JSON.
+UPSTREAM_MSGPACK = os.getenv('UPSTREAM_MSGPACK', 'false').lower() == 'true'
+UPSTREAM_ACCEPT = (
+    {'Accept': 'application/msgpack, application/json;q=0.9'} if UPSTREAM_MSGPACK else {}
+)
+
+# A GET still pending after the recent p95 latency of its service is raced
+# against a second attempt. HEDGE_DELAY applies until enough samples exist.
+HEDGE_DELAY = int(os.getenv('HEDGE_DELAY_MS', '50')) / 1000
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '0.95'))
+HEDGE_WINDOW = int(os.getenv('HEDGE_WINDOW', '200'))
+HEDGE_MIN_SAMPLES = 20
+
+
+def create_session():
+    """Create a pooled HTTP session shared by all forwarded requests."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=UPSTREAM_POOL_SIZE,
+        pool_block=True
+    )
+    # Mounted on the scheme so pinned IP addresses share the same pool settings
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def resolve_service(service_url):
+    """
+    Resolve a service hostname once and return (base URL, default headers).
+    Falls back to the configured URL when the name cannot be resolved yet.
+    """
+    parts = urlsplit(service_url)
+    if parts.scheme != 'http':
+        # Certificates are issued for the hostname, so HTTPS is never pinned
+        return service_url, UPSTREAM_ACCEPT
+    port = parts.port or 80
+    try:
+        family, _, _, _, sockaddr = socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)[0]
+    except socket.gaierror as e:
+        logger.warning(f"Could not resolve {parts.hostname}, using it unpinned: {e}")
+        return service_url, UPSTREAM_ACCEPT
+    address = f"[{sockaddr[0]}]" if family == socket.AF_INET6 else sockaddr[0]
+    return f"http://{address}:{port}{parts.path}", {'Host': parts.netloc, **UPSTREAM_ACCEPT}
 
 
-def forward_request(service_url, path, method='GET', data=None, params=None):
-    """Forward request to a backend service."""
-    url = f"{service_url}{path}"
-    try:
-        if method == 'GET':
-            response = requests.get(url, params=params, timeout=30)
-        elif method == 'POST':
-            response = requests.post(url, json=data, timeout=30)
-        elif method == 'PUT':
-            response = requests.put(url, json=data, timeout=30)
-        elif method == 'DELETE':
-            response = requests.delete(url, timeout=30)
-        else:
-            return jsonify({'error': 'Unsupported method'}), 405
-        
-        return response.json(), response.status_code
-    except requests.exceptions.ConnectionError:
-        logger.error(f"Connection error to {url}")
-        return {'error': f'Service unavailable: {service_url}'}, 503
-    except requests.exceptions.Timeout:
-        logger.error(f"Timeout connecting to {url}")
-        return {'error': 'Service timeout'}, 504
-    except Exception as e:
-        logger.error(f"Error forwarding request: {e}")
-        return {'error': str(e)}, 500
+def repin_service(service_url):
+    """Re-resolve a service after a connection failure, e.g. a restarted container."""
+    UPSTREAMS[service_url] = resolve_service(service_url)
 
 
-# ==================== HEALTH CHECK ====================
+# Keep-alive connections to the backend services are reused across requests
+SESSION = create_session()
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint."""
-    return jsonify({
-        'status': 'healthy',
-        'service': 'api-gateway'
-    })
+# Backend addresses are resolved at startup instead of on every new connection
+UPSTREAMS = {service_url: resolve_service(service_url) for service_url in SERVICE_URLS}
 
+# Stop calling a backend for a while once it keeps failing, rather than
+# piling more requests onto it
+BREAKERS = {
+    service_url: pybreaker.CircuitBreaker(fail_max=5, reset_timeout=30, name=service_url)
+    for service_url in SERVICE_URLS
+}
 
-# ==================== INSPECTION ENDPOINTS ====================
+# Latencies of the most recent GET attempts per backend, for hedge delays
+RECENT_LATENCIES = {service_url: deque(maxlen=HEDGE_WINDOW) for service_url in SERVICE_URLS}
 
-@app.route('/api/inspection/request', methods=['POST'])
-def request_inspection():
-    """
-    Request a technical inspection.
-    Returns available slots with IDs for scheduling.
-    """
-    data = request.get_json()
-    logger.info(f"Inspection request received for wagon: {data.get('wagon_id')}")
-    return forward_request(PLANNING_SERVICE_URL, '/inspection/request', 'POST', data)
+ping_cache()
 
 
-@app.route('/api/inspection/<int:inspection_id>', methods=['GET'])
-def get_inspection(inspection_id):
-    """Get inspection details by ID."""
-    return forward_request(PLANNING_SERVICE_URL, f'/inspection/{inspection_id}', 'GET')
+def error_response(message, status_code):
+    """Build a JSON error response."""
+    response = jsonify({'error': message})
+    response.status_code = status_code
+    return response
 
 
-@app.route('/api/inspection/schedule/<int:slot_id>', methods=['POST'])
-def schedule_by_slot(slot_id):
-    """
-    Schedule an inspection using a slot ID.
-    Simple method - just provide slot_id and location.
-    
-    Expected payload:
-    {
-        "inspection_id": 1,
-        "location": "Dépôt Paris Nord"
-    }
-    """
-    data = request.get_json()
-    logger.info(f"Scheduling inspection {data.get('inspection_id')} via slot {slot_id}")
-    return forward_request(PLANNING_SERVICE_URL, f'/inspection/schedule/{slot_id}', 'POST', data)
+def static_error_response(message, status_code):
+    """Build an error response once so it can be returned for every request."""
+    return Response(orjson.dumps({'error': message}), status=status_code, mimetype='application/json')
 
 
-@app.route('/api/inspection/<int:inspection_id>/schedule', methods=['POST'])
-def schedule_inspection(inspection_id):
-    """
-    Schedule an inspection with confirmed date and location (legacy method).
-    
-    Expected payload:
-    {
-        "scheduled_date": "2024-01-16T09:00:00",
-        "location": "Depot Paris Nord",
-        "technician_id": 1
-    }
-    """
-    data = request.get_json()
-    logger.info(f"Scheduling inspection {inspection_id}")
-    return forward_request(PLANNING_SERVICE_URL, f'/inspection/{inspection_id}/schedule', 'POST', data)
+# Fixed error bodies are serialized once at import
+NOT_FOUND_RESPONSE = static_error_response('Endpoint not found', 404)
+UNSUPPORTED_METHOD_RESPONSE = static_error_response('Unsupported method', 405)
+INTERNAL_ERROR_RESPONSE = static_error_response('Internal server error', 500)
+SERVICE_TIMEOUT_RESPONSE = static_error_response('Service timeout', 504)
+SERVICE_UNAVAILABLE_RESPONSES = {
+    service_url: static_error_response(f'Service unavailable: {service_url}', 503)
+    for service_url in SERVICE_URLS
+}
 
 
-@app.route('/api/inspection/<int:inspection_id>/complete', methods=['POST'])
-def complete_inspection(inspection_id):
-    """
-    Mark inspection as completed and provide findings.
-    
-    Expected payload:
-    {
-        "findings": "Brake pads worn, hydraulic leak detected",
-        "parts_needed": [
-            {"reference": "BP-001", "quantity": 4},
-            {"reference": "HL-002", "quantity": 1}
-        ],
-        "estimated_repair_hours": 8
-    }
-    """
-    data = request.get_json()
-    logger.info(f"Completing inspection {inspection_id}")
-    return forward_request(PLANNING_SERVICE_URL, f'/inspection/{inspection_id}/complete', 'POST', data)
+def stream_upstream(response):
+    """Relay the upstream body chunk by chunk, then release the connection."""
+    try:
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.close()
 
 
-@app.route('/api/inspection/availability', methods=['GET'])
-def get_availability():
-    """
-    Get available slots for inspection with slot IDs.
-    
-    Query params:
-    - start_date: Start date for availability search
-    - end_date: End date for availability search
-    """
-    params = {
-        'start_date': request.args.get('start_date'),
-        'end_date': request.args.get('end_date')
-    }
-    return forward_request(PLANNING_SERVICE_URL, '/inspection/availability', 'GET', params=params)
+def discard_response(future):
+    """Release the connection of a hedged attempt that lost the race."""
+    if future.exception() is None:
+        future.result().close()
+
 
+def hedge_delay(service_url):
+    """Time to wait before hedging a GET: the recent latency percentile of the service."""
+    samples = sorted(RECENT_LATENCIES[service_url])
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DELAY
+    return samples[min(int(len(samples) * HEDGE_PERCENTILE), len(samples) - 1)]
 
-# ==================== DEVIS (QUOTE) ENDPOINTS ====================
 
-@app.route('/api/devis/generate', methods=['POST'])
-def generate_devis():
+def start_attempt(send, service_url):
     """
-    Generate a quote (devis) after inspection.
-    Returns stock status and required modifications.
-    
-    Expected payload:
-    {
-        "inspection_id": 1,
-        "wagon_id": "WAG-001",
-        "client_company": "WagonLits",
-        "parts": [
-            {"reference": "BP-001", "quantity": 4},
-            {"reference": "HL-002", "quantity": 1}
-        ],
-        "intervention_hours": 8,
-        "proposed_intervention_date": "2024-01-20",
-        "urgency": "high"
-    }
+    Run `send` on its own thread and return a future for its result.
+    Under gevent workers the thread is a greenlet, so no pool caps how many
+    requests can be in flight.
     """
-    data = request.get_json()
-    logger.info(f"Generating devis for inspection: {data.get('inspection_id')}")
-    return forward_request(DEVIS_SERVICE_URL, '/devis/generate', 'POST', data)
+    future = Future()
 
+    def run():
+        start = time.perf_counter()
+        try:
+            response = send()
+        except Exception as e:
+            future.set_exception(e)
+            return
+        RECENT_LATENCIES[service_url].append(time.perf_counter() - start)
+        future.set_result(response)
 
-@app.route('/api/devis/<int:devis_id>', methods=['GET'])
-def get_devis(devis_id):
-    """Get quote details by ID."""
-    return forward_request(DEVIS_SERVICE_URL, f'/devis/{devis_id}', 'GET')
+    threading.Thread(target=run, daemon=True).start()
+    return future
 
 
-@app.route('/api/devis/<int:devis_id>/negotiate', methods=['PUT'])
-def negotiate_devis(devis_id):
+def hedged(send, service_url):
     """
-    Negotiate quote prices.
-    
-    Expected payload:
-    {
-        "discount_percentage": 10,
-        "negotiated_parts": [
-            {"part_id": 1, "negotiated_price": 45.00}
-        ],
-        "new_intervention_date": "2024-01-22"
-    }
+    Call `send`, starting a second identical attempt only once the first has
+    been pending longer than the service's hedge delay.
+    Returns the first successful result; only for idempotent requests.
     """
-    data = request.get_json()
-    logger.info(f"Negotiating devis {devis_id}")
-    return forward_request(DEVIS_SERVICE_URL, f'/devis/{devis_id}/negotiate', 'PUT', data)
-
-
-@app.route('/api/devis/<int:devis_id>/validate', methods=['POST'])
-def validate_devis(devis_id):
+    first = start_attempt(send, service_url)
+    try:
+        return first.result(timeout=hedge_delay(service_url))
+    except FutureTimeout:
+        pass
+
+    pending = {first, start_attempt(send, service_url)}
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((future for future in done if future.exception() is None), None)
+        if winner is not None or not pending:
+            winner = winner or done.pop()
+            for future in (done | pending) - {winner}:
+                future.add_done_callback(discard_response)
+            return winner.result()
+
+
+def forward_request(service_url, path, method='GET', data=None, params=None, headers=None):
     """
-    Validate and confirm the quote as an order.
-    Sends notifications to both ERPs via Kafka.
-    
-    Expected payload:
-    {
-        "confirmed_by": "John Doe",
-        "notes": "Urgent repair needed"
-    }
+    Forward request to a backend service.
+    The upstream body is streamed back as-is instead of being parsed.
     """
-    data = request.get_json()
-    logger.info(f"Validating devis {devis_id}")
-    return forward_request(DEVIS_SERVICE_URL, f'/devis/{devis_id}/validate', 'POST', data)
+    url = service_url + path
+    if method not in ('GET', 'POST', 'PUT', 'DELETE'):
+        return UNSUPPORTED_METHOD_RESPONSE
+    try:
+        base_url, upstream_headers = UPSTREAMS[service_url]
+        body = orjson.dumps(data) if data is not None else None
+        if body is not None:
+            headers = {**upstream_headers, **JSON_HEADERS, **(headers or {})}
+        elif headers:
+            headers = {**upstream_headers, **headers}
+        else:
+            headers = upstream_headers
+
+        def send():
+            return SESSION.request(
+                method, base_url + path, data=body, params=params, headers=headers,
+                timeout=30, stream=True
+            )
+
+        breaker = BREAKERS[service_url]
+        start = time.perf_counter()
+        try:
+            response = breaker.call(hedged, send, service_url) if method == 'GET' else breaker.call(send)
+        except Exception:
+            UPSTREAM_LATENCY.labels(SERVICE_NAMES[service_url], method, 'error').observe(
+                time.perf_counter() - start
+            )
+            raise
+        UPSTREAM_LATENCY.labels(SERVICE_NAMES[service_url], method, response.status_code).observe(
+            time.perf_counter() - start
+        )
+        content_type = response.headers.get('Content-Type', 'application/json')
+        if content_type.startswith('application/msgpack'):
+            proxied = Response(
+                orjson.dumps(ormsgpack.unpackb(response.content)),
+                status=response.status_code,
+                mimetype='application/json'
+            )
+        else:
+            proxied = Response(
+                stream_upstream(response),
+                status=response.status_code,
+                content_type=content_type
+            )
+            # The generator only releases the connection once iterated;
+            # callers that never read the body still free it on close()
+            proxied.call_on_close(response.close)
+        if 'ETag' in response.headers:
+            proxied.headers['ETag'] = response.headers['ETag']
+        return proxied
+    except pybreaker.CircuitBreakerError:
+        logger.warning(f"Circuit open for {service_url}, rejecting {url}")
+        return SERVICE_UNAVAILABLE_RESPONSES[service_url]
+    except requests.exceptions.ConnectionError:
+        logger.error(f"Connection error to {url}")
+        repin_service(service_url)
+        return SERVICE_UNAVAILABLE_RESPONSES[service_url]
+    except requests.exceptions.Timeout:
+        logger.error(f"Timeout connecting to {url}")
+        return SERVICE_TIMEOUT_RESPONSE
+    except Exception as e:
+        logger.error(f"Error forwarding request: {e}")
+        return error_response(str(e), 500)
+
+
+# ==================== CORS ====================
+
+# The allowed origin is fixed per deployment, so headers are built once
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': os.getenv('ALLOWED_ORIGIN', '*'),
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, Cache-Control',
+    'Access-Control-Max-Age': '600'
+}
+PREFLIGHT_RESPONSE = Response(b'', status=204, headers=CORS_HEADERS)
 
 
-@app.route('/api/devis/<int:devis_id>/reject', methods=['POST'])
-def reject_devis(devis_id):
-    """Reject a quote."""
-    data = request.get_json()
-    logger.info(f"Rejecting devis {devis_id}")
-    return forward_request(DEVIS_SERVICE_URL, f'/devis/{devis_id}/reject', 'POST', data)
+@app.after_request
+def add_cors_headers(response):
+    """Attach the static CORS headers to every response."""
+    response.headers.update(CORS_HEADERS)
+    return response
 
 
-# ==================== STOCK ENDPOINTS ====================
+@app.before_request
+def preflight():
+    """Answer CORS preflight requests for any gateway path before routing to a view."""
+    if request.method == 'OPTIONS':
+        return PREFLIGHT_RESPONSE
+
+
+# ==================== HEALTH CHECK ====================
+
+# Built once: liveness probes hit this endpoint many times per second
+HEALTH_BODY = b'{"status":"healthy","service":"api-gateway"}'
+HEALTH_RESPONSE = Response(HEALTH_BODY, status=200, mimetype='application/json')
+
+
+@app.route('/health', methods=['GET'], provide_automatic_options=False)
+def health_check():
+    """Health check endpoint."""
+    return HEALTH_RESPONSE
+
+
+# ==================== METRICS ====================
+
+@app.route('/metrics', methods=['GET'], provide_automatic_options=False)
+def metrics():
+    """Prometheus scrape endpoint."""
+    return metrics_response()
 
-@app.route('/api/stock/parts', methods=['GET'])
-def get_parts():
-    """Get all available parts."""
-    return forward_request(DEVIS_SERVICE_URL, '/stock/parts', 'GET')
 
+# ==================== ROUTE TABLE ====================
+# (gateway rule, methods, backend service, backend path, options)
+#
+# Options:
+# - cache_ttl: cache successful GET responses for this many seconds
+# - local_cache: also keep cached responses in process memory
+# - invalidates: gateway paths whose cached responses go stale on success;
+#   templates are filled from the URL arguments and the JSON payload
+
+ROUTES = [
+    # ---- Inspection ----
+
+    # Request a technical inspection, returns available slots with IDs.
+    ('/api/inspection/request', ['POST'], PLANNING_SERVICE_URL,
+     '/inspection/request', {}),
+
+    ('/api/inspection/<int:inspection_id>', ['GET'], PLANNING_SERVICE_URL,
+     '/inspection/{inspection_id}', {'cache_ttl': 60}),
+
+    # Schedule an inspection using a slot ID.
+    # Payload: {"inspection_id": 1, "location": "Dépôt Paris Nord"}
+    ('/api/inspection/schedule/<int:slot_id>', ['POST'], PLANNING_SERVICE_URL,
+     '/inspection/schedule/{slot_id}',
+     {'invalidates': ['/api/inspection/{inspection_id}', '/api/inspection/availability']}),
+
+    # Schedule with confirmed date and location (legacy method).
+    # Payload: {"scheduled_date": "2024-01-16T09:00:00",
+    #           "location": "Depot Paris Nord", "technician_id": 1}
+    ('/api/inspection/<int:inspection_id>/schedule', ['POST'], PLANNING_SERVICE_URL,
+     '/inspection/{inspection_id}/schedule',
+     {'invalidates': ['/api/inspection/{inspection_id}', '/api/inspection/availability']}),
 
-@app.route('/api/stock/parts/<reference>', methods=['GET'])
-def get_part_by_reference(reference):
-    """Get part details by reference."""
-    return forward_request(DEVIS_SERVICE_URL, f'/stock/parts/{reference}', 'GET')
+    # Mark inspection as completed and provide findings.
+    # Payload: {"findings": "Brake pads worn, hydraulic leak detected",
+    #           "parts_needed": [{"reference": "BP-001", "quantity": 4}],
+    #           "estimated_repair_hours": 8}
+    ('/api/inspection/<int:inspection_id>/complete', ['POST'], PLANNING_SERVICE_URL,
+     '/inspection/{inspection_id}/complete',
+     {'invalidates': ['/api/inspection/{inspection_id}']}),
 
+    # Available slots with IDs. Query params: start_date, end_date
+    ('/api/inspection/availability', ['GET'], PLANNING_SERVICE_URL,
+     '/inspection/availability', {'cache_ttl': 30}),
 
-@app.route('/api/stock/check', methods=['POST'])
+    # ---- Devis (quote) ----
+
+    # Generate a quote after inspection, returns stock status.
+    # Payload: {"inspection_id": 1, "wagon_id": "WAG-001",
+    #           "client_company": "WagonLits",
+    #           "parts": [{"reference": "BP-001", "quantity": 4}],
+    #           "intervention_hours": 8,
+    #           "proposed_intervention_date": "2024-01-20", "urgency": "high"}
+    ('/api/devis/generate', ['POST'], DEVIS_SERVICE_URL,
+     '/devis/generate', {}),
+
+    ('/api/devis/<int:devis_id>', ['GET'], DEVIS_SERVICE_URL,
+     '/devis/{devis_id}', {'cache_ttl': 60}),
+
+    # Negotiate quote prices.
+    # Payload: {"discount_percentage": 10,
+    #           "negotiated_parts": [{"part_id": 1, "negotiated_price": 45.00}],
+    #           "new_intervention_date": "2024-01-22"}
+    ('/api/devis/<int:devis_id>/negotiate', ['PUT'], DEVIS_SERVICE_URL,
+     '/devis/{devis_id}/negotiate',
+     {'invalidates': ['/api/devis/{devis_id}']}),
+
+    # Validate the quote as an order, notifies both ERPs via Kafka.
+    # Validation reserves stock, so cached part quantities are stale too.
+    # Payload: {"confirmed_by": "John Doe", "notes": "Urgent repair needed"}
+    ('/api/devis/<int:devis_id>/validate', ['POST'], DEVIS_SERVICE_URL,
+     '/devis/{devis_id}/validate',
+     {'invalidates': ['/api/devis/{devis_id}', '/api/stock/parts*']}),
+
+    ('/api/devis/<int:devis_id>/reject', ['POST'], DEVIS_SERVICE_URL,
+     '/devis/{devis_id}/reject',
+     {'invalidates': ['/api/devis/{devis_id}']}),
+
+    # ---- Stock ----
+
+    ('/api/stock/parts', ['GET'], DEVIS_SERVICE_URL,
+     '/stock/parts', {'cache_ttl': 300, 'local_cache': True}),
+
+    ('/api/stock/parts/<reference>', ['GET'], DEVIS_SERVICE_URL,
+     '/stock/parts/{reference}', {'cache_ttl': 300, 'local_cache': True}),
+
+    # ---- Notifications ----
+
+    # Query params: status, target_erp
+    ('/api/notifications', ['GET'], NOTIFICATION_SERVICE_URL,
+     '/notifications', {'cache_ttl': 10}),
+
+    ('/api/notifications/<int:notification_id>', ['GET'], NOTIFICATION_SERVICE_URL,
+     '/notifications/{notification_id}', {'cache_ttl': 10}),
+]
+
+
+def generic_proxy(service_url, path_template, invalidates, **url_kwargs):
+    """Forward the current request to the backend path built from the URL arguments."""
+    path = path_template.format_map(url_kwargs) if url_kwargs else path_template
+
+    # HEAD is forwarded as a GET; its body is dropped before reaching the client
+    if request.method in ('GET', 'HEAD'):
+        # Set by the response cache when it holds an expired copy of this resource
+        etag = g.get('revalidate_etag')
+        headers = {'If-None-Match': etag} if etag else None
+        return forward_request(service_url, path, 'GET', params=request.args, headers=headers)
+
+    data = request.get_json(silent=True, cache=True)
+    logger.info("Forwarding %s %s to %s%s", request.method, request.path, service_url, path)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("payload=%r", data)
+    response = forward_request(service_url, path, request.method, data)
+
+    if invalidates and response.status_code < 400:
+        fields = {**data, **url_kwargs} if isinstance(data, dict) else url_kwargs
+        invalidate(*(template.format_map(defaultdict(str, fields)) for template in invalidates))
+    return response
+
+
+def register_routes():
+    """Register every entry of the route table on the Flask app."""
+    for rule, methods, service_url, path_template, options in ROUTES:
+        view = partial(generic_proxy, service_url, path_template, options.get('invalidates'))
+        if options.get('cache_ttl'):
+            view = cached(ttl=options['cache_ttl'], local=options.get('local_cache', False))(view)
+        app.add_url_rule(rule, endpoint=rule, view_func=view, methods=methods,
+                         provide_automatic_options=False)
+
+
+register_routes()
+
+
+# ==================== FAN-OUT ENDPOINTS ====================
+
+# Large stock checks are split into shards sent to the Devis Service in parallel
+STOCK_CHECK_SHARD_SIZE = int(os.getenv('STOCK_CHECK_SHARD_SIZE', '25'))
+FANOUT_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('FANOUT_WORKERS', '16')))
+
+
+def post_json(service_url, path, data):
+    """POST a JSON payload to a backend service and return (status, parsed body)."""
+    base_url, upstream_headers = UPSTREAMS[service_url]
+    response = BREAKERS[service_url].call(
+        SESSION.post, base_url + path, data=orjson.dumps(data),
+        headers={**upstream_headers, **JSON_HEADERS}, timeout=30
+    )
+    if response.headers.get('Content-Type', '').startswith('application/msgpack'):
+        return response.status_code, ormsgpack.unpackb(response.content)
+    return response.status_code, orjson.loads(response.content)
+
+
+def merge_stock_checks(results):
+    """Combine the per-shard /stock/check responses into a single response."""
+    merged = {
+        'parts_status': [],
+        'summary': {
+            'total_parts_requested': 0,
+            'parts_available': 0,
+            'parts_insufficient': 0,
+            'parts_not_found': 0
+        },
+        'can_proceed': True,
+        'total_available_value': 0
+    }
+    modifications_required = []
+    message = None
+
+    for result in results:
+        merged['parts_status'].extend(result['parts_status'])
+        for field, count in result['summary'].items():
+            merged['summary'][field] += count
+        merged['can_proceed'] = merged['can_proceed'] and result['can_proceed']
+        merged['total_available_value'] += result['total_available_value']
+        if result.get('modifications_required'):
+            modifications_required.extend(result['modifications_required'])
+            message = result['message']
+        elif message is None:
+            message = result['message']
+
+    if modifications_required:
+        merged['modifications_required'] = modifications_required
+    merged['message'] = message
+    return merged
+
+
+@app.route('/api/stock/check', methods=['POST'], provide_automatic_options=False)
 def check_stock():
     """
     Check stock availability for parts.
     Returns detailed status and suggestions.
-    
+
     Expected payload:
     {
         "parts": [
@@ -253,40 +572,52 @@ def check_stock():
         ]
     }
     """
-    data = request.get_json()
-    return forward_request(DEVIS_SERVICE_URL, '/stock/check', 'POST', data)
-
-
-# ==================== NOTIFICATION ENDPOINTS ====================
-
-@app.route('/api/notifications', methods=['GET'])
-def get_notifications():
-    """Get all notifications."""
-    params = {
-        'status': request.args.get('status'),
-        'target_erp': request.args.get('target_erp')
-    }
-    return forward_request(NOTIFICATION_SERVICE_URL, '/notifications', 'GET', params=params)
-
+    data = request.get_json(silent=True, cache=True)
+    parts = data.get('parts') if isinstance(data, dict) else None
+    if not isinstance(parts, list) or len(parts) <= STOCK_CHECK_SHARD_SIZE:
+        return forward_request(DEVIS_SERVICE_URL, '/stock/check', 'POST', data)
+
+    shards = [
+        {**data, 'parts': parts[i:i + STOCK_CHECK_SHARD_SIZE]}
+        for i in range(0, len(parts), STOCK_CHECK_SHARD_SIZE)
+    ]
+    try:
+        results = list(FANOUT_EXECUTOR.map(
+            lambda shard: post_json(DEVIS_SERVICE_URL, '/stock/check', shard), shards
+        ))
+    except pybreaker.CircuitBreakerError:
+        logger.warning("Circuit open for %s during stock check", DEVIS_SERVICE_URL)
+        return SERVICE_UNAVAILABLE_RESPONSES[DEVIS_SERVICE_URL]
+    except requests.exceptions.ConnectionError:
+        logger.error("Connection error to %s during stock check", DEVIS_SERVICE_URL)
+        repin_service(DEVIS_SERVICE_URL)
+        return SERVICE_UNAVAILABLE_RESPONSES[DEVIS_SERVICE_URL]
+    except requests.exceptions.Timeout:
+        logger.error("Timeout during stock check")
+        return SERVICE_TIMEOUT_RESPONSE
+    except Exception as e:
+        logger.error(f"Error during sharded stock check: {e}")
+        return error_response(str(e), 500)
 
-@app.route('/api/notifications/<int:notification_id>', methods=['GET'])
-def get_notification(notification_id):
-    """Get notification by ID."""
-    return forward_request(NOTIFICATION_SERVICE_URL, f'/notifications/{notification_id}', 'GET')
+    for status, body in results:
+        if status != 200:
+            return jsonify(body), status
+    return jsonify(merge_stock_checks(body for _, body in results))
 
 
 # ==================== ERROR HANDLERS ====================
 
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({'error': 'Endpoint not found'}), 404
+    return NOT_FOUND_RESPONSE
 
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({'error': 'Internal server error'}), 500
+    return INTERNAL_ERROR_RESPONSE
 
 
 if __name__ == '__main__':
+    # Production runs under gunicorn (see gunicorn.conf.py)
     logger.info("Starting API Gateway on port 5000")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_ENV') == 'development')
@@ -0,0 +1,193 @@
+"""
+Response cache for idempotent API Gateway GET endpoints.
+Backed by Redis; falls back to calling the upstream service directly
+whenever Redis is unreachable. The hottest endpoints also keep a small
+per-process copy so cache hits skip the Redis round trip entirely.
+
+Entries are kept past their TTL so they can be revalidated upstream with
+If-None-Match; a 304 refreshes the entry without retransferring the body.
+"""
+from functools import wraps
+from flask import request, Response, g
+from cachetools import TTLCache
+import redis
+import fnmatch
+import hashlib
+import threading
+import os
+import time
+import logging
+
+from metrics import CACHE_HITS
+
+logger = logging.getLogger(__name__)
+
+REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+KEY_PREFIX = 'gateway:cache:'
+
+# Skip Redis for a while after a failure instead of paying a timeout per request
+REDIS_RETRY_DELAY = 30
+
+# Expired entries stay available for revalidation for this many TTLs
+REVALIDATE_WINDOW = 10
+
+redis_client = redis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    socket_timeout=0.2,
+    socket_connect_timeout=0.2
+)
+_redis_down_until = 0.0
+
+# Per-process cache in front of Redis. Other workers are not told about
+# invalidations, so their copies stay stale for at most LOCAL_CACHE_TTL.
+LOCAL_CACHE_TTL = int(os.getenv('LOCAL_CACHE_TTL', '30'))
+_local_cache = TTLCache(maxsize=1024, ttl=LOCAL_CACHE_TTL)
+_local_lock = threading.RLock()
+
+
+def _redis_available():
+    """Check whether Redis should be used for this request."""
+    return time.monotonic() >= _redis_down_until
+
+
+def _mark_redis_down(error):
+    """Disable Redis for a short period after a failure."""
+    global _redis_down_until
+    _redis_down_until = time.monotonic() + REDIS_RETRY_DELAY
+    logger.warning(f"Redis unavailable, bypassing cache for {REDIS_RETRY_DELAY}s: {error}")
+
+
+def cache_key(path, args):
+    """Build the cache key for a gateway path and its query arguments."""
+    query = sorted((k, v) for k, v in args.items(multi=True))
+    digest = hashlib.sha256(f"{path}?{query}".encode('utf-8')).hexdigest()
+    return f"{KEY_PREFIX}{path}:{digest}"
+
+
+def _load(key):
+    """Fetch a cache entry from Redis as a dict, or None."""
+    if not _redis_available():
+        return None
+    try:
+        entry = redis_client.hgetall(key)
+    except redis.RedisError as e:
+        _mark_redis_down(e)
+        return None
+    return entry or None
+
+
+def _store(key, body, etag, ttl):
+    """Write a cache entry to Redis, fresh for `ttl` seconds."""
+    if not _redis_available():
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(key, mapping={
+            'body': body,
+            'etag': etag or '',
+            'expires': time.time() + ttl
+        })
+        pipe.expire(key, ttl * REVALIDATE_WINDOW)
+        pipe.execute()
+    except redis.RedisError as e:
+        _mark_redis_down(e)
+
+
+def cached(ttl, local=False):
+    """
+    Cache successful responses of a GET view in Redis for `ttl` seconds.
+    With `local=True` responses are also kept in process memory.
+    Clients can bypass the lookup with a `Cache-Control: no-cache` header.
+
+    When an entry has expired but carries an upstream ETag, the view is
+    called with `g.revalidate_etag` set and may answer 304.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = cache_key(request.path, request.args)
+            bypass = 'no-cache' in request.headers.get('Cache-Control', '')
+            entry = None
+
+            if not bypass:
+                if local:
+                    with _local_lock:
+                        body = _local_cache.get(key)
+                    if body is not None:
+                        CACHE_HITS.labels(request.url_rule.rule).inc()
+                        return Response(body, status=200, mimetype='application/json')
+
+                entry = _load(key)
+                if entry is not None and float(entry[b'expires']) > time.time():
+                    body = entry[b'body']
+                    if local:
+                        with _local_lock:
+                            _local_cache[key] = body
+                    CACHE_HITS.labels(request.url_rule.rule).inc()
+                    return Response(body, status=200, mimetype='application/json')
+
+            if entry is not None and entry[b'etag']:
+                g.revalidate_etag = entry[b'etag'].decode('utf-8')
+
+            response = view(*args, **kwargs)
+
+            if response.status_code == 304 and entry is not None:
+                # The empty 304 body is never streamed to the client, so
+                # hand the upstream connection back to the pool now
+                response.close()
+                body = entry[b'body']
+                etag = g.revalidate_etag
+            elif response.status_code == 200:
+                # Buffers the streamed upstream body so it can be stored
+                body = response.get_data()
+                etag = response.headers.get('ETag')
+            else:
+                return response
+
+            if local:
+                with _local_lock:
+                    _local_cache[key] = body
+            _store(key, body, etag, ttl)
+            if response.status_code == 304:
+                CACHE_HITS.labels(request.url_rule.rule).inc()
+                return Response(body, status=200, mimetype='application/json')
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate(*paths):
+    """
+    Drop cached responses for the given gateway paths.
+    Paths may end with '*' to match every path sharing that prefix.
+    """
+    patterns = [
+        f"{KEY_PREFIX}{path}" if path.endswith('*') else f"{KEY_PREFIX}{path}:*"
+        for path in paths
+    ]
+
+    with _local_lock:
+        for key in list(_local_cache.keys()):
+            if any(fnmatch.fnmatchcase(key, pattern) for pattern in patterns):
+                _local_cache.pop(key, None)
+
+    if not _redis_available():
+        return
+    try:
+        for pattern in patterns:
+            keys = list(redis_client.scan_iter(match=pattern, count=500))
+            if keys:
+                redis_client.delete(*keys)
+    except redis.RedisError as e:
+        _mark_redis_down(e)
+
+
+def ping():
+    """Check Redis connectivity at startup."""
+    try:
+        redis_client.ping()
+        logger.info(f"Response cache connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
+    except redis.RedisError as e:
+        _mark_redis_down(e)
@@ -0,0 +1,46 @@
+"""
+Gunicorn configuration for the API Gateway.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+
+bind = '0.0.0.0:5000'
+
+# gevent workers multiplex in-flight upstream calls on one event loop
+# instead of blocking a whole worker for each forwarded request.
+worker_class = 'gevent'
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = 60
+
+# Hold client connections open longer than typical load balancer idle timeouts
+keepalive = 75
+
+accesslog = '-'
+
+
+class HealthCheckFilter(logging.Filter):
+    """Keep liveness probe hits out of the access log."""
+
+    def filter(self, record):
+        return not (isinstance(record.args, dict) and record.args.get('U') == '/health')
+
+
+logging.getLogger('gunicorn.access').addFilter(HealthCheckFilter())
+
+
+def on_starting(server):
+    """Start every run with an empty Prometheus multiprocess directory."""
+    metrics_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited."""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,33 @@
+"""
+Prometheus metrics for the API Gateway.
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates all workers.
+"""
+from flask import Response
+from prometheus_client import (
+    Counter, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+)
+from prometheus_client import multiprocess
+import os
+
+UPSTREAM_LATENCY = Histogram(
+    'gateway_upstream_seconds',
+    'Time until a backend service answered a forwarded request',
+    ['service', 'method', 'status'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+
+CACHE_HITS = Counter(
+    'gateway_cache_hits_total',
+    'Gateway responses served from the response cache',
+    ['endpoint']
+)
+
+
+def metrics_response():
+    """Render the current metrics in the Prometheus text format."""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
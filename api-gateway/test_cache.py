@@ -0,0 +1,73 @@
+"""
+Regression tests for the gateway response cache.
+Run with: python -m pytest api-gateway (or python -m unittest from api-gateway/).
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import os
+import threading
+import time
+import unittest
+
+POOL_SIZE = 2
+
+
+class NotModifiedHandler(BaseHTTPRequestHandler):
+    """Upstream stub answering 304 to every conditional GET."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        body = b'{"id":1}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RevalidationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), NotModifiedHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        os.environ['PLANNING_SERVICE_URL'] = f"http://127.0.0.1:{cls.server.server_port}"
+        os.environ['UPSTREAM_POOL_SIZE'] = str(POOL_SIZE)
+        import app
+        cls.app = app
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_revalidations_release_upstream_connections(self):
+        """More 304 revalidations than pooled connections must not block."""
+        expired = {b'body': b'{"id":1}', b'etag': b'"v1"', b'expires': str(time.time() - 1).encode()}
+        client = self.app.app.test_client()
+        statuses = []
+
+        def revalidate():
+            for _ in range(POOL_SIZE * 3):
+                statuses.append(client.get('/api/inspection/1').status_code)
+
+        with mock.patch('cache._load', return_value=expired), mock.patch('cache._store'):
+            worker = threading.Thread(target=revalidate, daemon=True)
+            worker.start()
+            worker.join(timeout=10)
+
+        self.assertFalse(worker.is_alive(), 'revalidation blocked waiting for a pooled connection')
+        self.assertEqual(statuses, [200] * (POOL_SIZE * 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
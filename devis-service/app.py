@@ -2,20 +2,32 @@
 Devis Service - Manages parts stock, quote generation, and price negotiations.
 """
 from flask import Flask, request, jsonify
+from flask_compress import Compress
 from datetime import datetime, date, timedelta
 from decimal import Decimal
 import os
 import sys
 import json
+import atexit
+import orjson
+import fastjsonschema
+from fastjsonschema import JsonSchemaException
+import threading
+import time
+from functools import singledispatch
+from itertools import chain, islice
+from cachetools import TTLCache
 import logging
 
 # Add shared folder to path
 sys.path.insert(0, '/app/shared')
 
 from models import (
-    get_all_parts,
+    iter_parts,
+    get_distinct_categories,
     get_part_by_reference,
     get_part_by_id,
+    get_parts_by_references,
     check_stock_availability,
     update_stock,
     create_devis,
@@ -23,7 +35,9 @@ from models import (
     update_devis_negotiation,
     validate_devis,
     reject_devis,
-    get_devis_by_status
+    iter_devis_by_status,
+    InsufficientStockError,
+    STOCK_CHANGE_HOOKS
 )
 
 # Configure logging
@@ -31,8 +45,29 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-
-# Kafka producer (lazy initialization)
+app.debug = False
+# Let gunicorn log unhandled errors with their traceback
+app.config['PROPAGATE_EXCEPTIONS'] = True
+# Serve '/devis/' and '/devis' alike instead of answering with a redirect
+app.url_map.strict_slashes = False
+
+# Compress JSON responses, streamed listings included; small bodies are sent as is
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_BR_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 1024
+Compress(app)
+
+# Kafka producer, created once at startup. Events are batched by the
+# producer and sent by its background thread instead of on the request
+# thread; idempotence keeps broker retries from duplicating events.
+KAFKA_PRODUCER_CONFIG = {
+    'linger_ms': 50,
+    'batch_size': 256 * 1024,
+    'acks': 'all',
+    'enable_idempotence': True,
+    'compression_type': 'lz4',
+    'value_serializer': orjson.dumps
+}
 kafka_producer = None
 
 
@@ -42,53 +77,172 @@ def get_kafka_producer():
     if kafka_producer is None:
         try:
             from kafka_utils import create_kafka_producer
-            kafka_producer = create_kafka_producer()
+            kafka_producer = create_kafka_producer(**KAFKA_PRODUCER_CONFIG)
+            atexit.register(kafka_producer.flush)
         except Exception as e:
             logger.error(f"Failed to create Kafka producer: {e}")
     return kafka_producer
 
 
 def publish_event(topic, key, data):
-    """Publish event to Kafka."""
+    """Queue an event for Kafka without waiting for the broker acknowledgement."""
     try:
         producer = get_kafka_producer()
         if producer:
-            from kafka_utils import publish_event as kafka_publish
-            kafka_publish(producer, topic, key, data)
-            logger.info(f"Event published to {topic}")
+            from kafka_utils import publish_event_nowait
+            publish_event_nowait(producer, topic, key, data)
+            logger.info(f"Event queued for {topic}")
         else:
             logger.warning("Kafka producer not available, event not published")
     except Exception as e:
         logger.error(f"Failed to publish event: {e}")
 
 
+get_kafka_producer()
+
+
+@singledispatch
+def convert_value(value):
+    """Convert a database value into a JSON-compatible one; others pass through."""
+    return value
+
+
+@convert_value.register
+def _(value: datetime):
+    return value.isoformat()
+
+
+@convert_value.register
+def _(value: date):
+    return str(value)
+
+
+@convert_value.register
+def _(value: Decimal):
+    return float(value)
+
+
+@convert_value.register
+def _(value: bytes):
+    return value.decode('utf-8')
+
+
+def _enc(value):
+    """Encode the values orjson does not handle natively."""
+    converted = convert_value(value)
+    if converted is value:
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+    return converted
+
+
+def _json_response(obj, status=200):
+    """Build a JSON response with orjson; dates and Decimals are encoded natively."""
+    return app.response_class(orjson.dumps(obj, default=_enc), status=status, mimetype='application/json')
+
+
+# Encoded parts/categories listings, dropped whenever stock changes.
+# The generation counter keeps listings read before a change out of the cache.
+_cat_cache = TTLCache(maxsize=32, ttl=30)
+_cat_cache_lock = threading.Lock()
+_cat_cache_generation = 0
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def clear_listing_cache():
+    """Drop cached parts and categories listings."""
+    global _cat_cache_generation
+    with _cat_cache_lock:
+        _cat_cache.clear()
+        _cat_cache_generation += 1
+
+
+STOCK_CHANGE_HOOKS.append(clear_listing_cache)
+
+
+def _get_listing(key):
+    """Return the cached encoded listing for `key`, or None."""
+    with _cat_cache_lock:
+        return _cat_cache.get(key)
+
+
+def _store_listing(key, body, generation):
+    """Cache an encoded listing unless stock changed since it was read."""
+    with _cat_cache_lock:
+        if generation == _cat_cache_generation:
+            _cat_cache[key] = body
+
+
+def _cached_listing(key, build):
+    """Return the encoded listing for `key`, building it with `build()` on a miss."""
+    body = _get_listing(key)
+    if body is None:
+        generation = _cat_cache_generation
+        body = orjson.dumps(build(), default=_enc)
+        _store_listing(key, body, generation)
+    return app.response_class(body, mimetype='application/json')
+
+
+def _stream_json_list(name, rows, to_dict, cache_key=None):
+    """
+    Stream rows as {"<name>": [...], "total": n} without building the list in memory.
+    The first row is fetched before streaming starts so query errors still
+    produce an error response. With `cache_key` the full body is cached.
+    """
+    generation = _cat_cache_generation
+    rows = iter(rows)
+    head = list(islice(rows, 1))
+
+    def generate():
+        buffer = bytearray(b'{"' + name.encode('utf-8') + b'":[')
+        chunks = [] if cache_key is not None else None
+        total = 0
+        for row in chain(head, rows):
+            if total:
+                buffer += b','
+            buffer += orjson.dumps(to_dict(row), default=_enc)
+            total += 1
+            if len(buffer) >= STREAM_CHUNK_SIZE:
+                chunk = bytes(buffer)
+                buffer.clear()
+                if chunks is not None:
+                    chunks.append(chunk)
+                yield chunk
+        buffer += b'],"total":' + str(total).encode('ascii') + b'}'
+        chunk = bytes(buffer)
+        if chunks is not None:
+            chunks.append(chunk)
+            _store_listing(cache_key, b''.join(chunks), generation)
+        yield chunk
+
+    return app.response_class(generate(), mimetype='application/json')
+
+
+# Conversions for the column types psycopg2 returns that JSON cannot hold
+def _walk(value):
+    """Recursively convert a row structure into JSON-compatible values."""
+    if isinstance(value, dict):
+        return {k: _walk(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_walk(v) for v in value]
+    return convert_value(value)
+
+
 def serialize_devis(devis_data):
     """Serialize devis for JSON response."""
     if devis_data is None:
         return None
-    
-    def convert_value(value):
-        if isinstance(value, datetime):
-            return value.isoformat()
-        elif isinstance(value, date):
-            return str(value)
-        elif isinstance(value, Decimal):
-            return float(value)
-        elif isinstance(value, bytes):
-            return value.decode('utf-8')
-        return value
-    
-    if isinstance(devis_data, dict):
-        result = {}
-        for key, value in devis_data.items():
-            if isinstance(value, dict):
-                result[key] = {k: convert_value(v) for k, v in value.items()}
-            elif isinstance(value, list):
-                result[key] = [{k: convert_value(v) for k, v in item.items()} if isinstance(item, dict) else convert_value(item) for item in value]
-            else:
-                result[key] = convert_value(value)
-        return result
-    return devis_data
+    return _walk(devis_data)
+
+
+@app.after_request
+def add_etag(response):
+    """Tag successful GET responses so callers can revalidate with If-None-Match."""
+    if (request.method == 'GET' and response.status_code == 200
+            and not response.direct_passthrough and not response.is_streamed):
+        response.add_etag()
+        response.make_conditional(request)
+    return response
 
 
 # ==================== HEALTH CHECK ====================
@@ -104,30 +258,59 @@ def health_check():
 
 # ==================== STOCK/PARTS ENDPOINTS ====================
 
+# Per-part messages, bound once so the templates are not rebuilt per item
+_MSG_NOT_IN_CATALOG = "La référence {reference} n'existe pas dans notre catalogue".format
+_MSG_INSUFFICIENT = "Stock insuffisant: {avail} disponibles sur {need} demandées".format
+_MSG_REDUCE_QUANTITY = "Seulement {avail} pièces disponibles. Réduisez à {avail} ou attendez le {restock}".format
+_MSG_AVAILABLE = "Disponible: {avail} en stock".format
+_MSG_REMOVE_PART = "❌ Référence '{reference}' introuvable. Retirez-la du devis.".format
+_MSG_ADJUST_QUANTITY = "⚠️ '{name}': Demandez {avail} au lieu de {need}. Réappro prévu le {restock}".format
+
+# Per-part status indexed by (found << 1) | available from check_stock_availability()
+_STATUS_INSUFFICIENT, _STATUS_AVAILABLE = 2, 3
+_STOCK_STATUS_FIELDS = (
+    {'status': 'NOT_IN_CATALOG'},
+    {'status': 'NOT_IN_CATALOG'},
+    {'status': 'INSUFFICIENT_STOCK'},
+    {'status': 'AVAILABLE'}
+)
+_DEVIS_STATUS_FIELDS = (
+    {'status': 'NOT_IN_CATALOG', 'available': False},
+    {'status': 'NOT_IN_CATALOG', 'available': False},
+    {'status': 'STOCK_INSUFFISANT', 'available': False},
+    {'status': 'DISPONIBLE', 'available': True}
+)
+
+
+def _status_bits(item):
+    """Encode an availability result as (found << 1) | available."""
+    return (bool(item.get('found')) << 1) | bool(item.get('available'))
+
+
+def part_summary(part):
+    """Build the /stock/parts entry for a part row."""
+    return {
+        'id': part['id'],
+        'reference': part['reference'],
+        'name': part['name'],
+        'description': part['description'],
+        'category': part['category'],
+        'catalog_price': part['catalog_price'],
+        'stock_quantity': part['stock_quantity'],
+        'available': part['stock_quantity'] > 0
+    }
+
+
 @app.route('/stock/parts', methods=['GET'])
 def list_parts():
     """Get all available parts."""
     try:
         category = request.args.get('category')
-        parts = get_all_parts(category)
-        
-        result = []
-        for part in parts:
-            result.append({
-                'id': part['id'],
-                'reference': part['reference'],
-                'name': part['name'],
-                'description': part['description'],
-                'category': part['category'],
-                'catalog_price': float(part['catalog_price']),
-                'stock_quantity': part['stock_quantity'],
-                'available': part['stock_quantity'] > 0
-            })
-        
-        return jsonify({
-            'parts': result,
-            'total': len(result)
-        })
+        key = ('parts', category)
+        body = _get_listing(key)
+        if body is not None:
+            return app.response_class(body, mimetype='application/json')
+        return _stream_json_list('parts', iter_parts(category), part_summary, cache_key=key)
     except Exception as e:
         logger.error(f"Error fetching parts: {e}")
         return jsonify({'error': str(e)}), 500
@@ -139,13 +322,13 @@ def get_part(reference):
     try:
         part = get_part_by_reference(reference)
         if part:
-            return jsonify({
+            return _json_response({
                 'id': part['id'],
                 'reference': part['reference'],
                 'name': part['name'],
                 'description': part['description'],
                 'category': part['category'],
-                'catalog_price': float(part['catalog_price']),
+                'catalog_price': part['catalog_price'],
                 'stock_quantity': part['stock_quantity'],
                 'reorder_threshold': part['reorder_threshold'],
                 'lead_time_days': part['lead_time_days'],
@@ -175,8 +358,12 @@ def check_stock():
         # Build detailed response
         parts_status = []
         modifications_required = []
+        counts = [0, 0, 0, 0]
+        total_value = 0
         
         for item in availability:
+            bits = _status_bits(item)
+            counts[bits] += 1
             part_info = {
                 'reference': item['reference'],
                 'name': item.get('name', 'Unknown'),
@@ -184,50 +371,46 @@ def check_stock():
                 'quantity_available': item.get('stock_quantity', 0),
                 'unit_price': item.get('catalog_price', 0),
                 'found_in_catalog': item.get('found', False),
-                'in_stock': item.get('available', False)
+                'in_stock': item.get('available', False),
+                **_STOCK_STATUS_FIELDS[bits]
             }
             
-            if not item.get('found'):
-                part_info['status'] = 'NOT_IN_CATALOG'
-                part_info['message'] = f"La référence {item['reference']} n'existe pas dans notre catalogue"
-                modifications_required.append({
-                    'action': 'REMOVE',
-                    'reference': item['reference'],
-                    'reason': 'Référence non trouvée dans le catalogue'
-                })
-            elif not item.get('available'):
-                part_info['status'] = 'INSUFFICIENT_STOCK'
+            if bits == _STATUS_AVAILABLE:
+                total_value += item.get('catalog_price', 0) * item.get('quantity_needed', 0)
+                part_info['message'] = _MSG_AVAILABLE(avail=item.get('stock_quantity', 0))
+            elif bits == _STATUS_INSUFFICIENT:
                 part_info['shortage'] = item.get('shortage', 0)
-                part_info['message'] = f"Stock insuffisant: {item.get('stock_quantity', 0)} disponibles sur {item.get('quantity_needed', 0)} demandées"
+                part_info['message'] = _MSG_INSUFFICIENT(avail=item.get('stock_quantity', 0), need=item.get('quantity_needed', 0))
                 part_info['estimated_restock_date'] = item.get('estimated_restock_date')
                 modifications_required.append({
                     'action': 'REDUCE_QUANTITY',
                     'reference': item['reference'],
                     'current_quantity': item.get('quantity_needed', 0),
                     'suggested_quantity': item.get('stock_quantity', 0),
-                    'reason': f"Seulement {item.get('stock_quantity', 0)} pièces disponibles. Réduisez à {item.get('stock_quantity', 0)} ou attendez le {item.get('estimated_restock_date', 'N/A')}"
+                    'reason': _MSG_REDUCE_QUANTITY(avail=item.get('stock_quantity', 0), restock=item.get('estimated_restock_date', 'N/A'))
                 })
             else:
-                part_info['status'] = 'AVAILABLE'
-                part_info['message'] = f"Disponible: {item.get('stock_quantity', 0)} en stock"
+                part_info['message'] = _MSG_NOT_IN_CATALOG(reference=item['reference'])
+                modifications_required.append({
+                    'action': 'REMOVE',
+                    'reference': item['reference'],
+                    'reason': 'Référence non trouvée dans le catalogue'
+                })
             
             parts_status.append(part_info)
         
-        all_available = all(item.get('available', False) for item in availability if item.get('found'))
-        total_value = sum(
-            item.get('catalog_price', 0) * item.get('quantity_needed', 0) 
-            for item in availability if item.get('found') and item.get('available')
-        )
-        
+        n_available = counts[_STATUS_AVAILABLE]
+        n_insufficient = counts[_STATUS_INSUFFICIENT]
+        n_not_found = len(availability) - n_available - n_insufficient
         response = {
             'parts_status': parts_status,
             'summary': {
                 'total_parts_requested': len(parts_list),
-                'parts_available': len([p for p in parts_status if p['status'] == 'AVAILABLE']),
-                'parts_insufficient': len([p for p in parts_status if p['status'] == 'INSUFFICIENT_STOCK']),
-                'parts_not_found': len([p for p in parts_status if p['status'] == 'NOT_IN_CATALOG'])
+                'parts_available': n_available,
+                'parts_insufficient': n_insufficient,
+                'parts_not_found': n_not_found
             },
-            'can_proceed': all_available and len([p for p in parts_status if p['status'] == 'NOT_IN_CATALOG']) == 0,
+            'can_proceed': n_insufficient == 0 and n_not_found == 0,
             'total_available_value': total_value
         }
         
@@ -247,14 +430,78 @@ def check_stock():
 def get_categories():
     """Get all part categories."""
     try:
-        parts = get_all_parts()
-        categories = list(set(p['category'] for p in parts if p['category']))
-        return jsonify({'categories': sorted(categories)})
+        return _cached_listing(('categories',), lambda: {'categories': get_distinct_categories()})
     except Exception as e:
         logger.error(f"Error fetching categories: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+# ==================== REQUEST SCHEMAS ====================
+
+# Compiled once at import into plain Python validators
+_DEVIS_GEN_SCHEMA = fastjsonschema.compile({
+    'type': 'object',
+    'required': ['wagon_id', 'client_company'],
+    'properties': {
+        'wagon_id': {'type': ['string', 'integer'], 'minLength': 1},
+        'client_company': {'type': 'string', 'minLength': 1},
+        'inspection_id': {'type': ['integer', 'null']},
+        'intervention_hours': {'type': 'number', 'minimum': 0},
+        'hourly_rate': {'type': 'number', 'minimum': 0},
+        'discount_percentage': {'type': 'number', 'minimum': 0, 'maximum': 100},
+        'proposed_intervention_date': {'type': ['string', 'null'], 'format': 'date'},
+        'urgency': {'type': 'string'},
+        'notes': {'type': ['string', 'null']},
+        'parts': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'required': ['reference'],
+                'properties': {
+                    'reference': {'type': 'string'},
+                    'quantity': {'type': 'integer', 'minimum': 1}
+                }
+            }
+        }
+    }
+})
+
+_DEVIS_NEGOTIATE_SCHEMA = fastjsonschema.compile({
+    'type': 'object',
+    'properties': {
+        'discount_percentage': {'type': ['number', 'null'], 'minimum': 0, 'maximum': 100},
+        'new_intervention_date': {'type': ['string', 'null'], 'format': 'date'},
+        'negotiated_parts': {
+            'type': ['array', 'null'],
+            'items': {
+                'type': 'object',
+                'required': ['part_id', 'negotiated_price'],
+                'properties': {
+                    'part_id': {'type': 'integer'},
+                    'negotiated_price': {'type': 'number', 'minimum': 0}
+                }
+            }
+        }
+    }
+})
+
+_DEVIS_VALIDATE_SCHEMA = fastjsonschema.compile({
+    'type': 'object',
+    'required': ['confirmed_by'],
+    'properties': {
+        'confirmed_by': {'type': 'string', 'minLength': 1},
+        'notes': {'type': ['string', 'null']}
+    }
+})
+
+_DEVIS_REJECT_SCHEMA = fastjsonschema.compile({
+    'type': 'object',
+    'properties': {
+        'reason': {'type': ['string', 'null']}
+    }
+})
+
+
 # ==================== DEVIS ENDPOINTS ====================
 
 @app.route('/devis/generate', methods=['POST'])
@@ -265,66 +512,69 @@ def generate_devis():
     """
     try:
         data = request.get_json()
-        
-        # Validate required fields
-        if not data.get('wagon_id'):
-            return jsonify({'error': 'wagon_id is required'}), 400
-        if not data.get('client_company'):
-            return jsonify({'error': 'client_company is required'}), 400
+        try:
+            _DEVIS_GEN_SCHEMA(data)
+        except JsonSchemaException as e:
+            return jsonify({'error': e.message}), 400
         
         parts_list = data.get('parts', [])
         
-        # Check stock availability
-        stock_check = check_stock_availability(parts_list)
+        # Load every referenced part once for both the stock check and the devis items
+        parts_map = get_parts_by_references({item['reference'] for item in parts_list})
+        stock_check = check_stock_availability(parts_list, parts_map)
         
         # Analyze stock issues and build suggestions
         parts_analysis = []
         modifications_required = []
-        has_issues = False
+        n_available = 0
+        total_parts = 0
         
         for item in stock_check:
+            bits = _status_bits(item)
             part_info = {
                 'reference': item['reference'],
                 'name': item.get('name', 'Unknown'),
                 'quantity_requested': item.get('quantity_needed', 0),
                 'quantity_in_stock': item.get('stock_quantity', 0),
                 'unit_price': item.get('catalog_price', 0),
-                'line_total': item.get('catalog_price', 0) * item.get('quantity_needed', 0) if item.get('found') and item.get('available') else 0
+                'line_total': item.get('catalog_price', 0) * item.get('quantity_needed', 0) if bits == _STATUS_AVAILABLE else 0,
+                **_DEVIS_STATUS_FIELDS[bits]
             }
             
-            if not item.get('found'):
-                part_info['status'] = 'NOT_IN_CATALOG'
-                part_info['available'] = False
-                has_issues = True
-                modifications_required.append({
-                    'action': 'RETIRER',
-                    'reference': item['reference'],
-                    'message': f"❌ Référence '{item['reference']}' introuvable. Retirez-la du devis."
-                })
-            elif not item.get('available'):
-                part_info['status'] = 'STOCK_INSUFFISANT'
-                part_info['available'] = False
+            if bits == _STATUS_AVAILABLE:
+                n_available += 1
+                total_parts += part_info['line_total']
+            elif bits == _STATUS_INSUFFICIENT:
                 part_info['shortage'] = item.get('shortage', 0)
                 part_info['restock_date'] = item.get('estimated_restock_date')
-                has_issues = True
                 modifications_required.append({
                     'action': 'MODIFIER_QUANTITE',
                     'reference': item['reference'],
                     'quantite_demandee': item.get('quantity_needed', 0),
                     'quantite_disponible': item.get('stock_quantity', 0),
-                    'message': f"⚠️ '{item.get('name')}': Demandez {item.get('stock_quantity', 0)} au lieu de {item.get('quantity_needed', 0)}. Réappro prévu le {item.get('estimated_restock_date', 'N/A')}"
+                    'message': _MSG_ADJUST_QUANTITY(
+                        name=item.get('name'),
+                        avail=item.get('stock_quantity', 0),
+                        need=item.get('quantity_needed', 0),
+                        restock=item.get('estimated_restock_date', 'N/A')
+                    )
                 })
             else:
-                part_info['status'] = 'DISPONIBLE'
-                part_info['available'] = True
+                modifications_required.append({
+                    'action': 'RETIRER',
+                    'reference': item['reference'],
+                    'message': _MSG_REMOVE_PART(reference=item['reference'])
+                })
             
             parts_analysis.append(part_info)
         
+        has_issues = n_available < len(parts_analysis)
+        
         # Create the devis (even with issues, so user can modify)
-        devis = create_devis(data, stock_check)
+        devis = create_devis(data, stock_check, parts_map)
+        intervention_date = devis.pop('proposed_intervention_date_str')
         
         # Calculate totals
-        total_parts = sum(p['line_total'] for p in parts_analysis if p['available'])
         intervention_hours = data.get('intervention_hours', 0)
         hourly_rate = 85.00
         labor_cost = intervention_hours * hourly_rate
@@ -346,8 +596,8 @@ def generate_devis():
             },
             'stock_status': {
                 'all_available': not has_issues,
-                'parts_available': len([p for p in parts_analysis if p['status'] == 'DISPONIBLE']),
-                'parts_with_issues': len([p for p in parts_analysis if p['status'] != 'DISPONIBLE'])
+                'parts_available': n_available,
+                'parts_with_issues': len(parts_analysis) - n_available
             }
         }
         
@@ -368,10 +618,11 @@ def generate_devis():
             'wagon_id': devis['wagon_id'],
             'client_company': devis['client_company'],
             'final_amount': float(devis['final_amount']),
-            'proposed_intervention_date': str(devis['proposed_intervention_date']),
+            'proposed_intervention_date': intervention_date,
             'has_stock_issues': has_issues,
             'status': 'draft',
-            'created_at': datetime.now().isoformat()
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'created_at_ms': int(time.time() * 1000)
         }
         publish_event('devis.generated', str(devis['id']), event_data)
         
@@ -389,7 +640,7 @@ def get_devis(devis_id):
     try:
         result = get_devis_by_id(devis_id)
         if result:
-            return jsonify(serialize_devis(result))
+            return _json_response(serialize_devis(result))
         return jsonify({'error': 'Devis not found'}), 404
     except Exception as e:
         logger.error(f"Error fetching devis: {e}")
@@ -401,6 +652,10 @@ def negotiate_devis_endpoint(devis_id):
     """Negotiate devis prices."""
     try:
         data = request.get_json()
+        try:
+            _DEVIS_NEGOTIATE_SCHEMA(data)
+        except JsonSchemaException as e:
+            return jsonify({'error': e.message}), 400
         
         # Verify devis exists
         existing = get_devis_by_id(devis_id)
@@ -411,18 +666,19 @@ def negotiate_devis_endpoint(devis_id):
             return jsonify({'error': f"Cannot negotiate a {existing['devis']['status']} devis"}), 400
         
         # Update negotiation
-        devis = update_devis_negotiation(
+        devis, updated_items = update_devis_negotiation(
             devis_id,
             data.get('discount_percentage'),
             data.get('negotiated_parts'),
             data.get('new_intervention_date')
         )
         
-        # Get updated devis with items
-        result = get_devis_by_id(devis_id)
+        # Merge the repriced items into the ones already loaded
+        updated = {item['id']: item for item in updated_items}
+        items = [updated.get(item['id'], item) for item in existing.get('items', [])]
         
         logger.info(f"Devis {devis_id} negotiated")
-        return jsonify(serialize_devis(result))
+        return jsonify(serialize_devis({'devis': dict(devis), 'items': items}))
         
     except Exception as e:
         logger.error(f"Error negotiating devis: {e}")
@@ -437,9 +693,10 @@ def validate_devis_endpoint(devis_id):
     """
     try:
         data = request.get_json()
-        
-        if not data.get('confirmed_by'):
-            return jsonify({'error': 'confirmed_by is required'}), 400
+        try:
+            _DEVIS_VALIDATE_SCHEMA(data)
+        except JsonSchemaException as e:
+            return jsonify({'error': e.message}), 400
         
         # Verify devis exists
         existing = get_devis_by_id(devis_id)
@@ -454,6 +711,10 @@ def validate_devis_endpoint(devis_id):
         
         # Validate the devis
         devis = validate_devis(devis_id, data['confirmed_by'], data.get('notes'))
+        if devis is None:
+            # Validated or rejected by a concurrent request since the check above
+            return jsonify({'error': 'Devis is no longer pending validation'}), 409
+        intervention_date = devis.pop('proposed_intervention_date_str')
         
         # Get items for the event
         items = existing.get('items', [])
@@ -475,24 +736,23 @@ def validate_devis_endpoint(devis_id):
             'wagon_id': devis['wagon_id'],
             'client_company': devis['client_company'],
             'final_amount': float(devis['final_amount']),
-            'intervention_date': str(devis['proposed_intervention_date']),
+            'intervention_date': intervention_date,
             'confirmed_by': devis['confirmed_by'],
             'parts': parts_list,
             'status': 'validated',
-            'validated_at': datetime.now().isoformat()
+            'validated_at': datetime.now().isoformat(timespec='seconds'),
+            'created_at_ms': int(time.time() * 1000)
         }
         publish_event('devis.validated', str(devis['id']), event_data)
         
-        # Get full result with items
-        result = get_devis_by_id(devis_id)
-        
-        response = serialize_devis(result)
+        # Validation does not change the items loaded above
+        response = serialize_devis({'devis': dict(devis), 'items': items})
         response['confirmation'] = {
             'status': 'validated',
             'message': '✅ Devis validé avec succès! Les deux ERP ont été notifiés.',
             'notifications_sent_to': ['ERP WagonLits', 'ERP DevMateriels'],
             'next_steps': [
-                f"Intervention prévue le {devis['proposed_intervention_date']}",
+                f"Intervention prévue le {intervention_date}",
                 f"Montant confirmé: {float(devis['final_amount'])}€",
                 "Le stock a été réservé pour cette commande"
             ]
@@ -501,6 +761,9 @@ def validate_devis_endpoint(devis_id):
         logger.info(f"Devis {devis_id} validated by {data['confirmed_by']}")
         return jsonify(response)
         
+    except InsufficientStockError as e:
+        logger.warning(f"Devis {devis_id} not validated: {e}")
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         logger.error(f"Error validating devis: {e}")
         return jsonify({'error': str(e)}), 500
@@ -511,6 +774,10 @@ def reject_devis_endpoint(devis_id):
     """Reject a devis."""
     try:
         data = request.get_json()
+        try:
+            _DEVIS_REJECT_SCHEMA(data)
+        except JsonSchemaException as e:
+            return jsonify({'error': e.message}), 400
         
         # Verify devis exists
         existing = get_devis_by_id(devis_id)
@@ -530,7 +797,8 @@ def reject_devis_endpoint(devis_id):
             'client_company': devis['client_company'],
             'reason': data.get('reason'),
             'status': 'rejected',
-            'rejected_at': datetime.now().isoformat()
+            'rejected_at': datetime.now().isoformat(timespec='seconds'),
+            'created_at_ms': int(time.time() * 1000)
         }
         publish_event('devis.rejected', str(devis['id']), event_data)
         
@@ -542,6 +810,19 @@ def reject_devis_endpoint(devis_id):
         return jsonify({'error': str(e)}), 500
 
 
+def devis_summary(d):
+    """Build the /devis listing entry for a devis row."""
+    return {
+        'id': d['id'],
+        'wagon_id': d['wagon_id'],
+        'client_company': d['client_company'],
+        'final_amount': d['final_amount'],
+        'status': d['status'],
+        'proposed_intervention_date': d['proposed_intervention_date'],
+        'created_at': d['created_at']
+    }
+
+
 @app.route('/devis', methods=['GET'])
 def list_devis():
     """List all devis with optional filters."""
@@ -549,29 +830,17 @@ def list_devis():
         status = request.args.get('status')
         client = request.args.get('client_company')
         
-        devis_list = get_devis_by_status(status, client)
-        
-        result = []
-        for d in devis_list:
-            result.append({
-                'id': d['id'],
-                'wagon_id': d['wagon_id'],
-                'client_company': d['client_company'],
-                'final_amount': float(d['final_amount']),
-                'status': d['status'],
-                'proposed_intervention_date': str(d['proposed_intervention_date']) if d['proposed_intervention_date'] else None,
-                'created_at': d['created_at'].isoformat() if d['created_at'] else None
-            })
-        
-        return jsonify({
-            'devis': result,
-            'total': len(result)
-        })
+        return _stream_json_list('devis', iter_devis_by_status(status, client), devis_summary)
     except Exception as e:
         logger.error(f"Error listing devis: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+# Build the URL matcher now rather than on each worker's first request
+app.url_map.update()
+
+
 if __name__ == '__main__':
+    # Production runs under gunicorn (see gunicorn.conf.py)
     logger.info("Starting Devis Service on port 5002")
-    app.run(host='0.0.0.0', port=5002, debug=True)
+    app.run(host='0.0.0.0', port=5002, debug=os.getenv('FLASK_ENV') == 'development')
@@ -0,0 +1,19 @@
+"""
+Gunicorn configuration for the Devis Service.
+"""
+import multiprocessing
+import os
+
+bind = '0.0.0.0:5002'
+
+# gevent workers overlap database and Kafka waits across requests
+worker_class = 'gevent'
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '500'))
+timeout = 60
+
+
+def post_fork(server, worker):
+    """Make psycopg2 yield to other greenlets while waiting on PostgreSQL."""
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -66,10 +66,10 @@ CREATE TABLE IF NOT EXISTS stock_movements (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Indexes
-CREATE INDEX IF NOT EXISTS idx_parts_reference ON parts(reference);
+-- Indexes (parts.reference lookups use the index behind its UNIQUE constraint)
 CREATE INDEX IF NOT EXISTS idx_parts_category ON parts(category);
-CREATE INDEX IF NOT EXISTS idx_devis_status ON devis(status);
+-- Matches the status/client filters of the devis listing, already in ORDER BY created_at DESC order
+CREATE INDEX IF NOT EXISTS idx_devis_status_client_created ON devis(status, client_company, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_devis_client ON devis(client_company);
 CREATE INDEX IF NOT EXISTS idx_devis_items_devis ON devis_items(devis_id);
 
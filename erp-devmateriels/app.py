@@ -3,48 +3,138 @@ ERP DevMateriels (DEMAT) Simulation - Simulates the DevMateriels internal ERP sy
 Receives notifications about inspections, devis, and orders.
 Manages interventions, billing, and stock reservations.
 """
-from flask import Flask, request, jsonify
-from datetime import datetime, date
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 from decimal import Decimal
+from itertools import chain, islice
 import os
+import time
+import threading
+import orjson
 import logging
 
 from models import (
     get_all_clients,
     get_client_by_name,
-    create_intervention,
-    update_intervention_from_notification,
+    clear_client_cache,
+    get_intervention_by_id,
     get_interventions,
+    iter_interventions,
     create_invoice,
     get_invoices,
-    create_stock_reservation,
     get_stock_reservations,
-    log_notification,
-    mark_notification_processed,
-    get_notifications_log
+    process_notification,
+    iter_notifications_log,
+    get_dashboard_stats,
+    listen_dashboard_changes
 )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def _default(value):
+    """Encode the values orjson does not handle natively."""
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(obj):
+    """Encode obj to JSON bytes with orjson."""
+    return orjson.dumps(obj, default=_default)
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype='application/json')
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Gzip JSON responses, streamed listings included; small bodies are sent as is
+app.config['COMPRESS_ALGORITHM'] = 'gzip'
+app.config['COMPRESS_MIN_SIZE'] = 1024
+Compress(app)
+
+# Listings are paged with ?limit=<n>&cursor=<id of the last row of the previous page>
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_BATCH_ROWS = 100
+
+# Serialized dashboard kept for a few seconds, dropped by every write endpoint
+DASHBOARD_CACHE_TTL = 5
+dashboard_cache = {'ts': 0, 'payload': None}
+
+# Comment line sent on idle dashboard streams so proxies keep them open
+DASHBOARD_STREAM_KEEPALIVE = 15
+
+# Each open stream holds a worker thread for as long as the client stays
+# connected; past this many per worker new streams get a 503, leaving the
+# other threads to regular requests
+DASHBOARD_STREAM_MAX = int(os.getenv(
+    'DASHBOARD_STREAM_MAX', max(1, int(os.getenv('GUNICORN_THREADS', '8')) // 2)
+))
+_dashboard_streams = threading.BoundedSemaphore(DASHBOARD_STREAM_MAX)
 
 
 def serialize_record(record):
-    """Serialize record for JSON response."""
+    """Serialize record for JSON response; values are already converted by the type casters in models."""
     if record is None:
         return None
+    return dict(record)
+
+
+def page_args(default_limit=DEFAULT_PAGE_SIZE):
+    """Read the limit and cursor query arguments of a paged listing."""
+    limit = request.args.get('limit', default_limit, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return limit, request.args.get('cursor', type=int)
+
+
+def stream_page(name, rows, limit):
+    """
+    Stream a page of rows as {"<name>": [...], "total": n, "next_cursor": id}.
+    `rows` may be a server-side cursor iterator; next_cursor is null on the last page.
+    The first row is fetched before streaming starts so query and pool errors
+    still produce an error response.
+    """
+    rows = iter(rows)
+    head = list(islice(rows, 1))
     
-    result = dict(record)
-    for key, value in result.items():
-        if isinstance(value, datetime):
-            result[key] = value.isoformat()
-        elif isinstance(value, date):
-            result[key] = str(value)
-        elif isinstance(value, Decimal):
-            result[key] = float(value)
-    return result
+    def generate():
+        yield f'{{"{name}":['
+        total, last_id, batch = 0, None, []
+        for row in chain(head, rows):
+            batch.append(dumps(serialize_record(row)).decode('utf-8'))
+            total += 1
+            last_id = row['id']
+            if len(batch) == STREAM_BATCH_ROWS:
+                yield (',' if total > len(batch) else '') + ','.join(batch)
+                batch = []
+        if batch:
+            yield (',' if total > len(batch) else '') + ','.join(batch)
+        next_cursor = last_id if total == limit else None
+        yield f'],"total":{total},"next_cursor":{dumps(next_cursor).decode("utf-8")}}}'
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def invalidate_dashboard():
+    """Force the next dashboard request to hit the database."""
+    dashboard_cache['ts'] = 0
 
 
 # ==================== HEALTH CHECK ====================
@@ -88,6 +178,13 @@ def get_client(company_name):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/clients/_invalidate_cache', methods=['POST'])
+def invalidate_client_cache():
+    """Drop the cached clients of the worker handling the request."""
+    clear_client_cache()
+    return jsonify({'status': 'cleared'})
+
+
 # ==================== INTERVENTIONS ====================
 
 @app.route('/interventions', methods=['GET'])
@@ -96,12 +193,10 @@ def list_interventions():
     try:
         status = request.args.get('status')
         client = request.args.get('client_company')
+        limit, cursor = page_args()
         
-        interventions = get_interventions(status, client)
-        return jsonify({
-            'interventions': [serialize_record(i) for i in interventions],
-            'total': len(interventions)
-        })
+        interventions = iter_interventions(status, client, limit, cursor)
+        return stream_page('interventions', interventions, limit)
     except Exception as e:
         logger.error(f"Error fetching interventions: {e}")
         return jsonify({'error': str(e)}), 500
@@ -111,8 +206,7 @@ def list_interventions():
 def get_intervention(intervention_id):
     """Get intervention by ID."""
     try:
-        interventions = get_interventions()
-        intervention = next((i for i in interventions if i['id'] == intervention_id), None)
+        intervention = get_intervention_by_id(intervention_id)
         
         if intervention:
             # Get stock reservations
@@ -131,6 +225,7 @@ def create_intervention_invoice(intervention_id):
     """Create invoice for an intervention."""
     try:
         invoice = create_invoice(intervention_id)
+        invalidate_dashboard()
         if invoice:
             logger.info(f"Invoice created: {invoice['invoice_number']}")
             return jsonify(serialize_record(invoice)), 201
@@ -148,12 +243,10 @@ def list_invoices():
     try:
         status = request.args.get('status')
         client = request.args.get('client_company')
+        limit, cursor = page_args()
         
-        invoices = get_invoices(status, client)
-        return jsonify({
-            'invoices': [serialize_record(i) for i in invoices],
-            'total': len(invoices)
-        })
+        invoices = get_invoices(status, client, limit, cursor)
+        return stream_page('invoices', invoices, limit)
     except Exception as e:
         logger.error(f"Error fetching invoices: {e}")
         return jsonify({'error': str(e)}), 500
@@ -167,12 +260,10 @@ def list_stock_reservations():
     try:
         status = request.args.get('status')
         intervention_id = request.args.get('intervention_id', type=int)
+        limit, cursor = page_args()
         
-        reservations = get_stock_reservations(intervention_id, status)
-        return jsonify({
-            'reservations': [serialize_record(r) for r in reservations],
-            'total': len(reservations)
-        })
+        reservations = get_stock_reservations(intervention_id, status, limit, cursor)
+        return stream_page('reservations', reservations, limit)
     except Exception as e:
         logger.error(f"Error fetching stock reservations: {e}")
         return jsonify({'error': str(e)}), 500
@@ -194,57 +285,19 @@ def receive_notification():
         
         logger.info(f"Received notification: {event_type}")
         
-        # Log the notification
-        notification = log_notification(event_type, 'NotificationService', data)
-        
-        # Process based on event type
-        if event_type == 'inspection.requested':
-            # Create new inspection intervention
-            create_intervention(event_data, 'inspection')
-            logger.info(f"Created inspection intervention for wagon {event_data.get('wagon_id')}")
-            
-        elif event_type == 'inspection.scheduled':
-            # Update intervention with schedule
-            update_intervention_from_notification(event_data)
-            logger.info(f"Updated inspection schedule for wagon {event_data.get('wagon_id')}")
-            
-        elif event_type == 'inspection.completed':
-            # Update intervention as completed
-            update_intervention_from_notification(event_data)
-            logger.info(f"Inspection completed for wagon {event_data.get('wagon_id')}")
-            
-        elif event_type == 'devis.generated':
-            # Update intervention with devis info
-            update_intervention_from_notification(event_data)
-            logger.info(f"Devis generated for wagon {event_data.get('wagon_id')}")
-            
-        elif event_type == 'devis.validated':
-            # Create repair intervention and invoice
-            intervention = update_intervention_from_notification(event_data)
-            if intervention and intervention.get('total_amount'):
-                # Create invoice
-                invoice = create_invoice(intervention['id'])
-                if invoice:
-                    logger.info(f"Invoice {invoice['invoice_number']} created for intervention {intervention['id']}")
-                
-                # Create stock reservations if parts info available
-                parts = event_data.get('parts_needed', [])
-                if parts:
-                    create_stock_reservation(intervention['id'], parts)
-                    logger.info(f"Stock reserved for intervention {intervention['id']}")
-            
-        elif event_type == 'devis.rejected':
-            # Update intervention as cancelled
-            event_data['status'] = 'cancelled'
-            update_intervention_from_notification(event_data)
-            logger.info(f"Devis rejected for wagon {event_data.get('wagon_id')}")
+        # Applied and logged by a single database function call
+        result = process_notification(event_type, 'NotificationService', data)
+        invalidate_dashboard()
         
-        # Mark notification as processed
-        mark_notification_processed(notification['id'])
+        if result['invoice_number']:
+            logger.info(f"Invoice {result['invoice_number']} created for intervention {result['intervention_id']}")
+        if result['reserved_parts']:
+            logger.info(f"Stock reserved for intervention {result['intervention_id']}")
+        logger.info(f"Processed {event_type} for wagon {event_data.get('wagon_id')}")
         
         return jsonify({
             'status': 'received',
-            'notification_id': notification['id'],
+            'notification_id': result['notification_id'],
             'event_type': event_type
         }), 200
         
@@ -260,12 +313,10 @@ def list_notifications():
         processed = request.args.get('processed')
         if processed is not None:
             processed = processed.lower() == 'true'
+        limit, cursor = page_args(default_limit=100)
         
-        notifications = get_notifications_log(processed)
-        return jsonify({
-            'notifications': [serialize_record(n) for n in notifications],
-            'total': len(notifications)
-        })
+        notifications = iter_notifications_log(processed, limit, cursor)
+        return stream_page('notifications', notifications, limit)
     except Exception as e:
         logger.error(f"Error fetching notifications: {e}")
         return jsonify({'error': str(e)}), 500
@@ -273,41 +324,74 @@ def list_notifications():
 
 # ==================== DASHBOARD ====================
 
+def dashboard_payload():
+    """Serialized dashboard summary, served from the cache while it is fresh."""
+    now = time.monotonic()
+    if now - dashboard_cache['ts'] < DASHBOARD_CACHE_TTL:
+        return dashboard_cache['payload']
+    
+    # Counters and revenue are aggregated by the database
+    summary = serialize_record(get_dashboard_stats())
+    interventions = get_interventions(limit=5)
+    invoices = get_invoices(limit=5)
+    clients = get_all_clients()
+    
+    payload = dumps({
+        'summary': summary,
+        'recent_interventions': [serialize_record(i) for i in interventions],
+        'recent_invoices': [serialize_record(i) for i in invoices],
+        'clients': [serialize_record(c) for c in clients]
+    })
+    dashboard_cache.update(payload=payload, ts=now)
+    return payload
+
+
 @app.route('/dashboard', methods=['GET'])
 def dashboard():
     """Get dashboard summary."""
     try:
-        clients = get_all_clients()
-        interventions = get_interventions()
-        invoices = get_invoices()
-        reservations = get_stock_reservations()
-        
-        # Calculate revenue
-        total_revenue = sum(float(i['amount_ht'] or 0) for i in invoices)
-        paid_revenue = sum(float(i['amount_ht'] or 0) for i in invoices if i['status'] == 'paid')
-        pending_revenue = sum(float(i['amount_ht'] or 0) for i in invoices if i['status'] in ['issued', 'draft'])
-        
-        return jsonify({
-            'summary': {
-                'total_clients': len(clients),
-                'active_interventions': len([i for i in interventions if i['status'] in ['pending', 'scheduled', 'confirmed']]),
-                'completed_interventions': len([i for i in interventions if i['status'] == 'completed']),
-                'total_invoices': len(invoices),
-                'pending_invoices': len([i for i in invoices if i['status'] in ['issued', 'draft']]),
-                'active_reservations': len([r for r in reservations if r['status'] == 'reserved']),
-                'total_revenue': total_revenue,
-                'paid_revenue': paid_revenue,
-                'pending_revenue': pending_revenue
-            },
-            'recent_interventions': [serialize_record(i) for i in interventions[:5]],
-            'recent_invoices': [serialize_record(i) for i in invoices[:5]],
-            'clients': [serialize_record(c) for c in clients]
-        })
+        return Response(dashboard_payload(), mimetype='application/json')
     except Exception as e:
         logger.error(f"Error fetching dashboard: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/dashboard/stream', methods=['GET'])
+def dashboard_stream():
+    """
+    Server-Sent Events stream of the dashboard summary.
+    Sends the current summary, then a new one after each write instead of being polled.
+    Answers 503 once DASHBOARD_STREAM_MAX streams are open in this worker.
+    """
+    if not _dashboard_streams.acquire(blocking=False):
+        return jsonify({'error': 'Too many open dashboard streams, poll /dashboard instead'}), 503, {
+            'Retry-After': str(DASHBOARD_STREAM_KEEPALIVE)
+        }
+    
+    def generate():
+        changes = listen_dashboard_changes(DASHBOARD_STREAM_KEEPALIVE)
+        try:
+            yield b'data: ' + dashboard_payload() + b'\n\n'
+            for changed in changes:
+                if not changed:
+                    yield b': keepalive\n\n'
+                    continue
+                # The write may come from another worker, whose cache drop we did not see
+                invalidate_dashboard()
+                yield b'data: ' + dashboard_payload() + b'\n\n'
+        finally:
+            changes.close()
+    
+    response = Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Runs even if the client leaves before the stream is first read
+    response.call_on_close(_dashboard_streams.release)
+    return response
+
+
 # ==================== REPORTS ====================
 
 @app.route('/reports/client/<company_name>', methods=['GET'])
@@ -340,4 +424,4 @@ def client_report(company_name):
 
 if __name__ == '__main__':
     logger.info("Starting ERP DevMateriels (DEMAT) simulation on port 5011")
-    app.run(host='0.0.0.0', port=5011, debug=True)
+    app.run(host='0.0.0.0', port=5011, debug=True, threaded=True)
@@ -0,0 +1,25 @@
+"""
+Gunicorn configuration for the ERP DevMateriels simulation.
+"""
+import multiprocessing
+import os
+
+bind = '0.0.0.0:5011'
+
+# Threaded workers overlap requests waiting on PostgreSQL.
+# Each worker has its own pool, keep DB_POOL_MAX >= threads.
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', min(multiprocessing.cpu_count(), 4)))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+keepalive = 30
+timeout = 60
+
+
+def post_worker_init(worker):
+    """Connect to PostgreSQL before the worker takes its first request."""
+    from models import open_pool
+    try:
+        open_pool()
+    except Exception as e:
+        # The pool is opened again on the first request
+        worker.log.warning(f"Could not open the database pool: {e}")
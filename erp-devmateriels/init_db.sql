@@ -73,10 +73,169 @@ CREATE TABLE IF NOT EXISTS notifications_log (
 );
 
 -- Indexes
-CREATE INDEX IF NOT EXISTS idx_interventions_status ON interventions(status);
-CREATE INDEX IF NOT EXISTS idx_interventions_client ON interventions(client_company);
-CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices(status);
+-- Match the status/client filters of the listings, already in ORDER BY created_at DESC order
+CREATE INDEX IF NOT EXISTS idx_interventions_status_client_created ON interventions(status, client_company, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_interventions_client_created ON interventions(client_company, created_at DESC);
+-- One intervention per inspection, target of the notification upserts
+CREATE UNIQUE INDEX IF NOT EXISTS idx_interventions_inspection ON interventions(external_inspection_id);
+-- Latest intervention of a devis or wagon, looked up by notifications without an inspection id
+CREATE INDEX IF NOT EXISTS idx_interventions_devis_created ON interventions(external_devis_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_interventions_wagon_created ON interventions(wagon_code, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_invoices_status_client_created ON invoices(status, client_company, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_stock_reservations_status ON stock_reservations(status);
+CREATE INDEX IF NOT EXISTS idx_notifications_processed_created ON notifications_log(processed, created_at DESC);
+
+-- Notification processing
+-- Applies a notification received from the Notification Service and logs it in one transaction
+
+-- Create an intervention from the event data of a notification
+CREATE OR REPLACE FUNCTION create_intervention_from_event(event_data JSONB)
+RETURNS interventions AS $$
+DECLARE
+    v_client_company VARCHAR(100) := COALESCE(event_data->>'client_company', 'WagonLits');
+    result interventions;
+BEGIN
+    INSERT INTO interventions
+        (external_inspection_id, external_devis_id, client_id, client_company,
+         wagon_code, intervention_type, scheduled_date, technician_assigned,
+         status, total_amount, notes)
+    VALUES (
+        (event_data->>'inspection_id')::INTEGER,
+        (event_data->>'devis_id')::INTEGER,
+        (SELECT id FROM clients WHERE company_name = v_client_company),
+        v_client_company,
+        event_data->>'wagon_id',
+        'inspection',
+        COALESCE(NULLIF(event_data->>'scheduled_date', ''), NULLIF(event_data->>'intervention_date', ''))::DATE,
+        event_data->>'technician_name',
+        CASE WHEN event_data->>'status' IN ('scheduled', 'completed') THEN event_data->>'status' ELSE 'pending' END,
+        (event_data->>'final_amount')::DECIMAL,
+        event_data->>'notes'
+    )
+    RETURNING * INTO result;
+    RETURN result;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Update the intervention matching the event, or create it.
+-- Events carrying an inspection id are applied with a single upsert.
+CREATE OR REPLACE FUNCTION upsert_intervention_from_event(event_data JSONB)
+RETURNS interventions AS $$
+DECLARE
+    v_client_company VARCHAR(100) := COALESCE(event_data->>'client_company', 'WagonLits');
+    v_scheduled_date DATE := COALESCE(
+        NULLIF(event_data->>'scheduled_date', ''), NULLIF(event_data->>'intervention_date', ''))::DATE;
+    v_status VARCHAR(50) := CASE event_data->>'status'
+        WHEN 'validated' THEN 'confirmed' ELSE event_data->>'status' END;
+    result interventions;
+BEGIN
+    IF event_data->>'inspection_id' IS NOT NULL THEN
+        INSERT INTO interventions
+            (external_inspection_id, external_devis_id, client_id, client_company,
+             wagon_code, intervention_type, scheduled_date, technician_assigned,
+             status, total_amount, notes)
+        VALUES (
+            (event_data->>'inspection_id')::INTEGER,
+            (event_data->>'devis_id')::INTEGER,
+            (SELECT id FROM clients WHERE company_name = v_client_company),
+            v_client_company,
+            event_data->>'wagon_id',
+            'inspection',
+            v_scheduled_date,
+            event_data->>'technician_name',
+            CASE WHEN v_status IN ('scheduled', 'completed') THEN v_status ELSE 'pending' END,
+            (event_data->>'final_amount')::DECIMAL,
+            event_data->>'notes'
+        )
+        ON CONFLICT (external_inspection_id) DO UPDATE
+        SET external_devis_id = COALESCE(EXCLUDED.external_devis_id, interventions.external_devis_id),
+            scheduled_date = COALESCE(EXCLUDED.scheduled_date, interventions.scheduled_date),
+            technician_assigned = COALESCE(EXCLUDED.technician_assigned, interventions.technician_assigned),
+            status = COALESCE(v_status, interventions.status),
+            total_amount = COALESCE(EXCLUDED.total_amount, interventions.total_amount),
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING * INTO result;
+        RETURN result;
+    END IF;
+
+    UPDATE interventions
+    SET external_devis_id = COALESCE((event_data->>'devis_id')::INTEGER, external_devis_id),
+        scheduled_date = COALESCE(v_scheduled_date, scheduled_date),
+        technician_assigned = COALESCE(event_data->>'technician_name', technician_assigned),
+        status = COALESCE(v_status, status),
+        total_amount = COALESCE((event_data->>'final_amount')::DECIMAL, total_amount),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = (
+        SELECT id FROM interventions
+        WHERE CASE WHEN event_data->>'devis_id' IS NOT NULL
+                   THEN external_devis_id = (event_data->>'devis_id')::INTEGER
+                   ELSE wagon_code = event_data->>'wagon_id' END
+        ORDER BY created_at DESC LIMIT 1
+    )
+    RETURNING * INTO result;
+
+    IF result.id IS NULL THEN
+        RETURN create_intervention_from_event(event_data);
+    END IF;
+    RETURN result;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION process_notification(event_type TEXT, source TEXT, payload JSONB)
+RETURNS JSONB AS $$
+DECLARE
+    event_data JSONB := COALESCE(payload->'event_data', '{}'::JSONB);
+    intervention interventions;
+    v_invoice_number VARCHAR(50);
+    v_reserved INTEGER := 0;
+    v_notification_id INTEGER;
+BEGIN
+    CASE event_type
+        WHEN 'inspection.requested', 'inspection.scheduled', 'inspection.completed', 'devis.generated' THEN
+            intervention := upsert_intervention_from_event(event_data);
+        WHEN 'devis.rejected' THEN
+            intervention := upsert_intervention_from_event(event_data || '{"status": "cancelled"}'::JSONB);
+        WHEN 'devis.validated' THEN
+            intervention := upsert_intervention_from_event(event_data);
+            IF intervention.total_amount <> 0 THEN
+                v_invoice_number := 'FAC-' || to_char(CURRENT_TIMESTAMP, 'YYYYMM') || '-'
+                    || upper(substr(md5(random()::TEXT), 1, 6));
+                INSERT INTO invoices
+                    (invoice_number, intervention_id, client_id, client_company,
+                     amount_ht, tva_rate, amount_ttc, status, issued_date, due_date)
+                VALUES (
+                    v_invoice_number, intervention.id,
+                    (SELECT id FROM clients WHERE company_name = intervention.client_company),
+                    intervention.client_company, intervention.total_amount, 20.00,
+                    intervention.total_amount * 1.20, 'issued', CURRENT_DATE, CURRENT_DATE + 30
+                );
+
+                INSERT INTO stock_reservations
+                    (intervention_id, part_reference, part_name, quantity, status)
+                SELECT intervention.id, part->>'reference', part->>'name',
+                       COALESCE((part->>'quantity')::INTEGER, 1), 'reserved'
+                FROM jsonb_array_elements(COALESCE(event_data->'parts_needed', '[]'::JSONB)) AS part;
+                GET DIAGNOSTICS v_reserved = ROW_COUNT;
+            END IF;
+        ELSE
+            NULL;
+    END CASE;
+
+    INSERT INTO notifications_log (event_type, source, payload, processed, processed_at)
+    VALUES (event_type, source, payload, true, CURRENT_TIMESTAMP)
+    RETURNING id INTO v_notification_id;
+
+    -- Delivered to dashboard streams on commit
+    PERFORM pg_notify('dashboard_changed', event_type);
+
+    RETURN jsonb_build_object(
+        'notification_id', v_notification_id,
+        'intervention_id', intervention.id,
+        'invoice_number', v_invoice_number,
+        'reserved_parts', v_reserved
+    );
+END;
+$$ LANGUAGE plpgsql;
 
 -- Insert client data
 INSERT INTO clients (company_name, contact_name, contact_email, contact_phone, contract_type, annual_contract_value) VALUES
@@ -3,45 +3,117 @@ ERP WagonLits Simulation - Simulates the WagonLits ERP system.
 Receives notifications from DevMateriels and can initiate inspection requests.
 """
 from flask import Flask, request, jsonify
-from datetime import datetime
+from flask.json.provider import JSONProvider
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
+from decimal import Decimal
 import os
 import logging
+import orjson
 
 from models import (
     get_all_wagons,
     get_wagon_by_code,
     create_inspection_request,
+    set_inspection_status,
     update_inspection_from_notification,
     get_inspection_requests,
     create_or_update_devis,
     get_devis_list,
+    get_devis_by_id,
     create_order,
     get_orders,
-    log_notification,
-    mark_notification_processed,
-    get_notifications_log
+    queue_notification_log,
+    log_notifications_batch,
+    mark_notifications_processed,
+    get_notifications_log,
+    get_dashboard_stats,
+    db_cursor
 )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def _default(value):
+    """Encode the values orjson does not handle natively."""
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson; dates and datetimes are encoded natively."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_default), mimetype='application/json')
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 API_GATEWAY_URL = os.getenv('API_GATEWAY_URL', 'http://localhost:5000')
 
 
+def create_session():
+    """Create a pooled HTTP session for the calls to the API Gateway."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        # POSTs are only retried when the connection could not be made
+        max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504], raise_on_status=False)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Keep-alive connections to the API Gateway are reused across requests
+SESSION = create_session()
+
+# Sends inspection requests to DevMateriels after the local record is committed
+FORWARD_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('FORWARD_WORKERS', '8')))
+
+# Runs the independent dashboard queries side by side
+DASHBOARD_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('DASHBOARD_WORKERS', '8')))
+
+# Seconds clients may reuse a GET response without asking again, per endpoint
+CACHE_MAX_AGE = {
+    'list_wagons': 5,
+    'get_wagon': 300,
+    'dashboard': 5,
+    'list_notifications': 5
+}
+
+
 def serialize_record(record):
-    """Serialize record for JSON response."""
+    """Serialize record for JSON response; orjson encodes dates and datetimes itself."""
     if record is None:
         return None
-    
-    result = dict(record)
-    for key, value in result.items():
-        if isinstance(value, datetime):
-            result[key] = value.isoformat()
-    return result
+    return dict(record)
+
+
+@app.after_request
+def add_cache_headers(response):
+    """Tag successful GET responses so callers can revalidate with If-None-Match."""
+    if request.method == 'GET' and response.status_code == 200 and not response.direct_passthrough:
+        response.add_etag()
+        max_age = CACHE_MAX_AGE.get(request.endpoint)
+        if max_age:
+            response.headers['Cache-Control'] = f'private, max-age={max_age}'
+        response.make_conditional(request)
+    return response
 
 
 # ==================== HEALTH CHECK ====================
@@ -87,6 +159,27 @@ def get_wagon(wagon_code):
 
 # ==================== INSPECTION REQUESTS ====================
 
+def forward_inspection_request(inspection_id, api_payload):
+    """Send an inspection request to the DevMateriels API Gateway, flagging the local record on failure."""
+    try:
+        response = SESSION.post(
+            f"{API_GATEWAY_URL}/api/inspection/request",
+            json=api_payload,
+            timeout=30
+        )
+        if response.status_code in [200, 201]:
+            logger.info(f"Inspection request {inspection_id} sent to DevMateriels: {response.json()}")
+            return
+        logger.warning(f"DevMateriels API error for inspection request {inspection_id}: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Failed to contact DevMateriels API for inspection request {inspection_id}: {e}")
+    
+    try:
+        set_inspection_status(inspection_id, 'send_failed')
+    except Exception as e:
+        logger.error(f"Error flagging inspection request {inspection_id}: {e}")
+
+
 @app.route('/inspections', methods=['GET'])
 def list_inspections():
     """Get all inspection requests."""
@@ -105,7 +198,8 @@ def list_inspections():
 @app.route('/inspections/request', methods=['POST'])
 def request_inspection():
     """
-    Create a new inspection request and send to DevMateriels API.
+    Create a new inspection request and queue it for the DevMateriels API.
+    Requests that cannot be delivered are flagged with status 'send_failed'.
     
     Expected payload:
     {
@@ -133,36 +227,15 @@ def request_inspection():
             'requested_date': data.get('requested_date')
         }
         
-        try:
-            response = requests.post(
-                f"{API_GATEWAY_URL}/api/inspection/request",
-                json=api_payload,
-                timeout=30
-            )
-            
-            if response.status_code in [200, 201]:
-                external_data = response.json()
-                logger.info(f"Inspection request sent to DevMateriels: {external_data}")
-                
-                return jsonify({
-                    'local_inspection': serialize_record(inspection),
-                    'devmateriels_response': external_data,
-                    'message': 'Inspection request sent successfully'
-                }), 201
-            else:
-                logger.warning(f"DevMateriels API error: {response.status_code}")
-                return jsonify({
-                    'local_inspection': serialize_record(inspection),
-                    'warning': f'Local record created but DevMateriels API returned {response.status_code}'
-                }), 201
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to contact DevMateriels API: {e}")
-            return jsonify({
-                'local_inspection': serialize_record(inspection),
-                'warning': 'Local record created but failed to contact DevMateriels API'
-            }), 201
-            
+        # Sent in the background, the caller does not wait for DevMateriels
+        FORWARD_EXECUTOR.submit(forward_inspection_request, inspection['id'], api_payload)
+        
+        return jsonify({
+            'local_inspection': serialize_record(inspection),
+            'status': 'queued',
+            'message': 'Inspection request queued for DevMateriels'
+        }), 202
+        
     except Exception as e:
         logger.error(f"Error creating inspection: {e}")
         return jsonify({'error': str(e)}), 500
@@ -195,6 +268,7 @@ def validate_devis(devis_id):
         "confirmed_by": "Jean Martin",
         "notes": "Approved for immediate intervention"
     }
+    The DevMateriels id of the devis is always read from the local record.
     """
     try:
         data = request.get_json()
@@ -203,23 +277,25 @@ def validate_devis(devis_id):
             return jsonify({'error': 'confirmed_by is required'}), 400
         
         # Get the devis
-        devis_list = get_devis_list()
-        devis = next((d for d in devis_list if d['id'] == devis_id), None)
+        devis = get_devis_by_id(devis_id)
         
         if not devis:
             return jsonify({'error': 'Devis not found'}), 404
+        external_devis_id = devis['external_devis_id']
         
         # Send validation to DevMateriels
         try:
-            response = requests.post(
-                f"{API_GATEWAY_URL}/api/devis/{devis['external_devis_id']}/validate",
+            response = SESSION.post(
+                f"{API_GATEWAY_URL}/api/devis/{external_devis_id}/validate",
                 json=data,
                 timeout=30
             )
             
             if response.status_code in [200, 201]:
                 # Create local order
-                order = create_order(devis_id, data['confirmed_by'])
+                order = create_order(devis_id, external_devis_id, data['confirmed_by'])
+                if not order:
+                    return jsonify({'error': 'Devis not found'}), 404
                 
                 logger.info(f"Devis {devis_id} validated, order created: {order['order_number']}")
                 return jsonify({
@@ -259,6 +335,15 @@ def list_orders():
 
 # ==================== NOTIFICATIONS (Received from DevMateriels) ====================
 
+def apply_notification(event_type, event_data, cur):
+    """Apply a received event to the local records, within the caller's transaction."""
+    if event_type in ['inspection.requested', 'inspection.scheduled', 'inspection.completed']:
+        update_inspection_from_notification(event_data, cur=cur)
+        
+    elif event_type in ['devis.generated', 'devis.validated', 'devis.rejected']:
+        create_or_update_devis(event_data, cur=cur)
+
+
 @app.route('/api/notifications', methods=['POST'])
 def receive_notification():
     """
@@ -273,22 +358,23 @@ def receive_notification():
         
         logger.info(f"Received notification: {event_type}")
         
-        # Log the notification
-        notification = log_notification(event_type, 'DevMateriels', data)
+        try:
+            with db_cursor() as cur:
+                apply_notification(event_type, event_data, cur)
+            error = None
+        except Exception as e:
+            error = e
         
-        # Process based on event type
-        if event_type in ['inspection.requested', 'inspection.scheduled', 'inspection.completed']:
-            update_inspection_from_notification(event_data)
-            
-        elif event_type in ['devis.generated', 'devis.validated', 'devis.rejected']:
-            create_or_update_devis(event_data)
+        # Logged in the background; a failing event is logged unprocessed
+        notification_id = queue_notification_log(event_type, 'DevMateriels', data, processed=error is None)
         
-        # Mark as processed
-        mark_notification_processed(notification['id'])
+        if error is not None:
+            logger.error(f"Error applying notification {notification_id}: {error}")
+            return jsonify({'error': str(error), 'notification_id': notification_id}), 500
         
         return jsonify({
             'status': 'received',
-            'notification_id': notification['id'],
+            'notification_id': notification_id,
             'event_type': event_type
         }), 200
         
@@ -297,6 +383,49 @@ def receive_notification():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/notifications/batch', methods=['POST'])
+def receive_notifications_batch():
+    """
+    Receive a backlog of notifications, e.g. replayed after an outage.
+    The body is a list of notifications shaped like the ones sent to /api/notifications.
+    They are logged with one COPY; each is then applied on its own savepoint.
+    """
+    try:
+        notifications = request.get_json()
+        if not isinstance(notifications, list):
+            return jsonify({'error': 'A list of notifications is required'}), 400
+        
+        logger.info(f"Received {len(notifications)} notifications")
+        
+        processed, failed = [], []
+        with db_cursor() as cur:
+            ids = log_notifications_batch(notifications, 'DevMateriels', cur=cur)
+            
+            for notification_id, data in zip(ids, notifications):
+                cur.execute("SAVEPOINT apply_event")
+                try:
+                    apply_notification(data.get('event_type'), data.get('event_data', {}), cur)
+                    cur.execute("RELEASE SAVEPOINT apply_event")
+                    processed.append(notification_id)
+                except Exception as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT apply_event")
+                    logger.error(f"Error applying notification {notification_id}: {e}")
+                    failed.append(notification_id)
+            
+            mark_notifications_processed(processed, cur=cur)
+        
+        return jsonify({
+            'status': 'received',
+            'notification_ids': ids,
+            'processed': len(processed),
+            'failed': failed
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error processing notification batch: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/notifications', methods=['GET'])
 def list_notifications():
     """Get notifications log."""
@@ -321,23 +450,18 @@ def list_notifications():
 def dashboard():
     """Get dashboard summary."""
     try:
-        wagons = get_all_wagons()
-        inspections = get_inspection_requests()
-        devis = get_devis_list()
-        orders = get_orders()
+        # Counters are aggregated by the database, only the recent rows are fetched,
+        # each on its own connection at the same time
+        summary = DASHBOARD_EXECUTOR.submit(get_dashboard_stats)
+        inspections = DASHBOARD_EXECUTOR.submit(get_inspection_requests, limit=5)
+        devis = DASHBOARD_EXECUTOR.submit(get_devis_list, limit=5)
+        orders = DASHBOARD_EXECUTOR.submit(get_orders, limit=5)
         
         return jsonify({
-            'summary': {
-                'total_wagons': len(wagons),
-                'wagons_in_service': len([w for w in wagons if w['status'] == 'in_service']),
-                'wagons_in_maintenance': len([w for w in wagons if w['status'] == 'in_maintenance']),
-                'pending_inspections': len([i for i in inspections if i['status'] in ['requested', 'scheduled']]),
-                'pending_devis': len([d for d in devis if d['status'] == 'received']),
-                'active_orders': len([o for o in orders if o['status'] in ['pending', 'confirmed']])
-            },
-            'recent_inspections': [serialize_record(i) for i in inspections[:5]],
-            'recent_devis': [serialize_record(d) for d in devis[:5]],
-            'recent_orders': [serialize_record(o) for o in orders[:5]]
+            'summary': dict(summary.result()),
+            'recent_inspections': [serialize_record(i) for i in inspections.result()],
+            'recent_devis': [serialize_record(d) for d in devis.result()],
+            'recent_orders': [serialize_record(o) for o in orders.result()]
         })
     except Exception as e:
         logger.error(f"Error fetching dashboard: {e}")
@@ -346,4 +470,4 @@ def dashboard():
 
 if __name__ == '__main__':
     logger.info("Starting ERP WagonLits simulation on port 5010")
-    app.run(host='0.0.0.0', port=5010, debug=True)
+    app.run(host='0.0.0.0', port=5010, threaded=True)
@@ -0,0 +1,27 @@
+"""
+Gunicorn configuration for the ERP WagonLits simulation.
+"""
+import multiprocessing
+import os
+
+bind = '0.0.0.0:5010'
+
+# gevent workers overlap the waits on PostgreSQL and the API Gateway,
+# so one worker keeps many notifications in flight
+worker_class = 'gevent'
+workers = int(os.getenv('GUNICORN_WORKERS', min(multiprocessing.cpu_count(), 4)))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '500'))
+keepalive = 30
+timeout = 60
+
+
+def post_fork(server, worker):
+    """Make psycopg2 yield to other greenlets while waiting on PostgreSQL."""
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def post_worker_init(worker):
+    """Keep notifications_log partitioned for the coming months while the worker runs."""
+    from models import maintain_partitions
+    maintain_partitions()
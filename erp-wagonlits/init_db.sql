@@ -50,7 +50,10 @@ CREATE TABLE IF NOT EXISTS devis_received (
 -- Orders table
 CREATE TABLE IF NOT EXISTS orders (
     id SERIAL PRIMARY KEY,
-    order_number VARCHAR(50) UNIQUE,
+    -- ORD-WAGL-<YYYYMMDD>-<6 random hex digits>
+    order_number VARCHAR(50) UNIQUE
+        DEFAULT 'ORD-WAGL-' || to_char(CURRENT_TIMESTAMP, 'YYYYMMDD') || '-'
+                || upper(substr(replace(gen_random_uuid()::text, '-', ''), 1, 6)),
     devis_id INTEGER REFERENCES devis_received(id),
     wagon_code VARCHAR(50),
     total_amount DECIMAL(10,2),
@@ -60,22 +63,65 @@ CREATE TABLE IF NOT EXISTS orders (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Notifications received log
+-- Notifications received log, partitioned by month so tail reads only touch
+-- the newest partitions and old months can be dropped
 CREATE TABLE IF NOT EXISTS notifications_log (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     event_type VARCHAR(100),
     source VARCHAR(100),
-    payload JSONB,
+    -- lz4 compresses large event payloads faster than the default pglz
+    payload JSONB COMPRESSION lz4,
     processed BOOLEAN DEFAULT false,
     processed_at TIMESTAMP,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Creates the monthly partitions of `parent` from the current month to
+-- `months_ahead` months ahead; also run by the service periodically.
+-- A month whose rows already landed in the DEFAULT partition cannot get its
+-- own partition, so it is skipped with a warning and stays in DEFAULT.
+-- Old months are purged with DROP TABLE <parent>_<YYYY>_<MM>.
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(parent TEXT, months_ahead INTEGER DEFAULT 12)
+RETURNS VOID AS $$
+DECLARE
+    v_month TIMESTAMP;
+BEGIN
+    -- Every worker runs this, often at the same time
+    PERFORM pg_advisory_xact_lock(hashtext(parent));
+    FOR i IN 0..months_ahead LOOP
+        v_month := date_trunc('month', CURRENT_TIMESTAMP) + make_interval(months => i);
+        BEGIN
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                parent || '_' || to_char(v_month, 'YYYY_MM'),
+                parent,
+                v_month,
+                v_month + INTERVAL '1 month'
+            );
+        EXCEPTION WHEN check_violation THEN
+            RAISE WARNING 'Skipping partition %_%: its rows are already in the default partition',
+                parent, to_char(v_month, 'YYYY_MM');
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_monthly_partitions('notifications_log');
+-- Catches rows past the last monthly partition
+CREATE TABLE IF NOT EXISTS notifications_log_default PARTITION OF notifications_log DEFAULT;
 
 -- Indexes
-CREATE INDEX IF NOT EXISTS idx_inspections_status ON inspection_requests(status);
-CREATE INDEX IF NOT EXISTS idx_devis_status ON devis_received(status);
-CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
-CREATE INDEX IF NOT EXISTS idx_notifications_processed ON notifications_log(processed);
+-- Match the status filters of the listings, already in ORDER BY created_at DESC order
+CREATE INDEX IF NOT EXISTS idx_inspections_status_created ON inspection_requests(status, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_devis_status_created ON devis_received(status, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_processed_created ON notifications_log(processed, created_at DESC);
+-- Lookups done for every notification received
+CREATE INDEX IF NOT EXISTS idx_inspections_wagon_created ON inspection_requests(wagon_code, created_at DESC);
+-- One local record per DevMateriels inspection/devis, target of the notification upserts
+CREATE UNIQUE INDEX IF NOT EXISTS idx_inspections_external ON inspection_requests(external_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_devis_external ON devis_received(external_devis_id);
 
 -- Insert sample wagons
 INSERT INTO wagons (wagon_code, wagon_type, year_built, last_maintenance_date, next_scheduled_maintenance, status) VALUES
@@ -2,33 +2,58 @@
 Notification Service - Kafka consumer that pushes notifications to ERPs.
 """
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 import os
 import sys
 import json
 import logging
 import time
+import orjson
 
 # Add shared folder to path
 sys.path.insert(0, '/app/shared')
 
 from models import (
     get_notification_template,
+    clear_template_cache,
     create_notification,
+    create_notifications,
     update_notification_status,
+    update_notification_statuses,
     get_notification_by_id,
     get_notifications,
     get_pending_notifications,
-    get_notification_stats
+    get_notification_stats,
+    ensure_partitions
 )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson; dates and datetimes are encoded natively."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ERP URLs
 ERP_WAGONLITS_URL = os.getenv('ERP_WAGONLITS_URL', 'http://localhost:5010')
@@ -45,13 +70,50 @@ KAFKA_TOPICS = [
     'devis.rejected'
 ]
 
+
+def create_session():
+    """Create a pooled HTTP session for the calls to the ERPs."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=64,
+        # POSTs are only retried when the connection could not be made
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Keep-alive connections to the ERPs, shared by the Kafka consumer and the request threads
+SESSION = create_session()
+
+# Kafka messages are stored and dispatched in batches of up to KAFKA_BATCH_SIZE
+KAFKA_BATCH_SIZE = int(os.getenv('KAFKA_BATCH_SIZE', '100'))
+KAFKA_POLL_TIMEOUT_MS = 500
+
+# Concurrent sends of the notifications of a Kafka batch
+DISPATCH_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('DISPATCH_WORKERS', '16')))
+
+# Concurrent sends of /notifications/retry-pending
+RETRY_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('RETRY_WORKERS', '16')))
+
 # Kafka consumer thread
 kafka_consumer_thread = None
 consumer_running = False
+KAFKA_WATCHDOG_INTERVAL = 30
 
+# notifications partitions are topped up daily, sooner after a failure
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv('PARTITION_MAINTENANCE_INTERVAL', '86400'))
+PARTITION_RETRY_INTERVAL = 60
 
-def send_notification_to_erp(notification_id, target_erp, payload):
-    """Send notification to target ERP via HTTP POST."""
+
+def deliver_notification(notification_id, target_erp, payload):
+    """
+    POST a notification to its target ERP without recording the outcome.
+    Returns (notification_id, status, http_status_code, detail), where detail is
+    the response body when sent and the error message when failed.
+    """
     try:
         if target_erp == 'ERP_WAGL':
             url = f"{ERP_WAGONLITS_URL}/api/notifications"
@@ -62,107 +124,96 @@ def send_notification_to_erp(notification_id, target_erp, payload):
         
         logger.info(f"Sending notification to {url}")
         
-        response = requests.post(
-            url,
-            json=payload,
-            timeout=30,
-            headers={'Content-Type': 'application/json'}
-        )
+        response = SESSION.post(url, json=payload, timeout=(3, 10))
         
         if response.status_code in [200, 201, 202]:
-            update_notification_status(
-                notification_id, 
-                'sent', 
-                response.status_code, 
-                response.text[:500]
-            )
             logger.info(f"Notification {notification_id} sent successfully to {target_erp}")
-            return True
-        else:
-            update_notification_status(
-                notification_id, 
-                'failed', 
-                response.status_code, 
-                error_message=f"HTTP {response.status_code}: {response.text[:200]}"
-            )
-            logger.warning(f"Notification {notification_id} failed: HTTP {response.status_code}")
-            return False
+            return notification_id, 'sent', response.status_code, response.text[:500]
+        
+        logger.warning(f"Notification {notification_id} failed: HTTP {response.status_code}")
+        return (
+            notification_id, 'failed', response.status_code,
+            f"HTTP {response.status_code}: {response.text[:200]}"
+        )
             
     except requests.exceptions.ConnectionError as e:
-        update_notification_status(
-            notification_id, 
-            'failed', 
-            error_message=f"Connection error: {str(e)[:200]}"
-        )
         logger.error(f"Connection error sending notification {notification_id}: {e}")
-        return False
+        return notification_id, 'failed', None, f"Connection error: {str(e)[:200]}"
     except Exception as e:
-        update_notification_status(
-            notification_id, 
-            'failed', 
-            error_message=str(e)[:200]
-        )
         logger.error(f"Error sending notification {notification_id}: {e}")
-        return False
+        return notification_id, 'failed', None, str(e)[:200]
 
 
-def process_kafka_message(event_type, event_data):
-    """Process a Kafka message and create notifications for both ERPs."""
-    logger.info(f"Processing Kafka message: {event_type}")
+def send_notification_to_erp(notification_id, target_erp, payload):
+    """Send notification to target ERP via HTTP POST and record the outcome."""
+    _, status, http_status_code, detail = deliver_notification(notification_id, target_erp, payload)
+    if status == 'sent':
+        update_notification_status(notification_id, 'sent', http_status_code, detail)
+        return True
+    update_notification_status(notification_id, 'failed', http_status_code, error_message=detail)
+    return False
+
+
+def send_notifications(notifications, executor):
+    """
+    Send stored notifications concurrently on `executor`, then record every
+    outcome in one UPDATE. Returns the deliver_notification() outcomes.
+    """
+    outcomes = list(executor.map(
+        lambda n: deliver_notification(n['id'], n['target_erp'], n['payload']),
+        notifications
+    ))
+    update_notification_statuses(outcomes)
+    return outcomes
+
+
+def build_notification_rows(event_type, event_data):
+    """Build the create_notifications() rows of a Kafka event, one per ERP."""
+    # Get notification template
+    template = get_notification_template(event_type)
     
-    try:
-        # Get notification template
-        template = get_notification_template(event_type)
-        
-        # Create notification for WagonLits
-        wagonlits_payload = {
-            'event_type': event_type,
-            'event_data': event_data,
-            'template': template['template_wagonlits'] if template else {},
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        wagonlits_notification = create_notification(
-            event_type=event_type,
-            event_id=str(event_data.get('inspection_id') or event_data.get('devis_id')),
-            source_service='kafka',
-            target_erp='ERP_WAGL',
-            payload=wagonlits_payload
-        )
-        
-        # Create notification for DevMateriels
-        devmateriels_payload = {
-            'event_type': event_type,
-            'event_data': event_data,
-            'template': template['template_devmateriels'] if template else {},
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        devmateriels_notification = create_notification(
-            event_type=event_type,
-            event_id=str(event_data.get('inspection_id') or event_data.get('devis_id')),
-            source_service='kafka',
-            target_erp='ERP_DEMAT',
-            payload=devmateriels_payload
-        )
-        
-        # Send notifications
-        send_notification_to_erp(
-            wagonlits_notification['id'], 
-            'ERP_WAGL', 
-            wagonlits_payload
-        )
-        
-        send_notification_to_erp(
-            devmateriels_notification['id'], 
-            'ERP_DEMAT', 
-            devmateriels_payload
-        )
-        
-        logger.info(f"Notifications created and sent for event: {event_type}")
-        
-    except Exception as e:
-        logger.error(f"Error processing Kafka message: {e}")
+    event_id = str(event_data.get('inspection_id') or event_data.get('devis_id'))
+    
+    # Payload for WagonLits
+    wagonlits_payload = {
+        'event_type': event_type,
+        'event_data': event_data,
+        'template': template['template_wagonlits'] if template else {},
+        'timestamp': datetime.now().isoformat()
+    }
+    
+    # Payload for DevMateriels
+    devmateriels_payload = {
+        'event_type': event_type,
+        'event_data': event_data,
+        'template': template['template_devmateriels'] if template else {},
+        'timestamp': datetime.now().isoformat()
+    }
+    
+    return [
+        (event_type, event_id, 'kafka', 'ERP_WAGL', wagonlits_payload),
+        (event_type, event_id, 'kafka', 'ERP_DEMAT', devmateriels_payload)
+    ]
+
+
+def store_kafka_messages(messages):
+    """
+    Create the notifications of a batch of Kafka messages in one INSERT.
+    Returns them as the id/target_erp/payload dicts send_notifications() takes.
+    """
+    rows = []
+    for message in messages:
+        try:
+            rows += build_notification_rows(message.topic, message.value)
+        except (AttributeError, TypeError) as e:
+            logger.error(f"Skipping malformed Kafka message {message.topic}@{message.offset}: {e}")
+    if not rows:
+        return []
+    ids = create_notifications(rows)
+    return [
+        {'id': notification_id, 'target_erp': row[3], 'payload': row[4]}
+        for notification_id, row in zip(ids, rows)
+    ]
 
 
 def kafka_consumer_loop():
@@ -177,27 +228,40 @@ def kafka_consumer_loop():
     try:
         from kafka_utils import create_kafka_consumer
         
+        # Offsets are committed once the notifications of a batch are stored
         consumer = create_kafka_consumer(
             topics=KAFKA_TOPICS,
-            group_id='notification-service'
+            group_id='notification-service',
+            enable_auto_commit=False
         )
         
         logger.info(f"Kafka consumer connected, listening to topics: {KAFKA_TOPICS}")
         consumer_running = True
         
-        for message in consumer:
-            if not consumer_running:
-                break
-                
+        while consumer_running:
+            batch = consumer.poll(timeout_ms=KAFKA_POLL_TIMEOUT_MS, max_records=KAFKA_BATCH_SIZE)
+            messages = [message for records in batch.values() for message in records]
+            if not messages:
+                continue
+            
+            logger.info(f"Received {len(messages)} Kafka messages")
             try:
-                event_type = message.topic
-                event_data = message.value
-                
-                logger.info(f"Received Kafka message: {event_type}")
-                process_kafka_message(event_type, event_data)
-                
+                notifications = store_kafka_messages(messages)
             except Exception as e:
-                logger.error(f"Error processing Kafka message: {e}")
+                logger.error(f"Error storing Kafka messages, retrying the batch: {e}")
+                # Rewind so the batch is polled again
+                for partition, records in batch.items():
+                    consumer.seek(partition, records[0].offset)
+                time.sleep(1)
+                continue
+            consumer.commit()
+            
+            try:
+                send_notifications(notifications, DISPATCH_EXECUTOR)
+                logger.info(f"Notifications created and sent for {len(messages)} events")
+            except Exception as e:
+                # Stored notifications stay pending for /notifications/retry-pending
+                logger.error(f"Error sending notifications: {e}")
                 
     except Exception as e:
         logger.error(f"Kafka consumer error: {e}")
@@ -214,16 +278,38 @@ def start_kafka_consumer():
         logger.info("Kafka consumer thread started")
 
 
-def serialize_notification(notification):
-    """Serialize notification for JSON response."""
-    if notification is None:
-        return None
-    
-    result = dict(notification)
-    for key, value in result.items():
-        if isinstance(value, datetime):
-            result[key] = value.isoformat()
-    return result
+def watch_kafka_consumer():
+    """Start the Kafka consumer, then restart it every KAFKA_WATCHDOG_INTERVAL seconds if it died."""
+    start_kafka_consumer()
+    watchdog = threading.Timer(KAFKA_WATCHDOG_INTERVAL, watch_kafka_consumer)
+    watchdog.daemon = True
+    watchdog.start()
+
+
+def maintain_partitions():
+    """
+    Create the upcoming monthly partitions of notifications now, then again
+    every PARTITION_MAINTENANCE_INTERVAL seconds while the service runs.
+    """
+    delay = PARTITION_MAINTENANCE_INTERVAL
+    try:
+        ensure_partitions()
+    except Exception as e:
+        # Rows past the last partition go to notifications_default meanwhile
+        logger.warning(f"Could not create the notifications partitions: {e}")
+        delay = PARTITION_RETRY_INTERVAL
+    timer = threading.Timer(delay, maintain_partitions)
+    timer.daemon = True
+    timer.start()
+
+
+@app.after_request
+def add_etag(response):
+    """Tag successful GET responses so callers can revalidate with If-None-Match."""
+    if request.method == 'GET' and response.status_code == 200 and not response.direct_passthrough:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
 
 
 # ==================== HEALTH CHECK ====================
@@ -238,22 +324,34 @@ def health_check():
     })
 
 
+# ==================== TEMPLATES ====================
+
+@app.route('/templates/_invalidate_cache', methods=['POST'])
+def invalidate_template_cache():
+    """Drop the cached templates, or only the one of the `event_type` query argument."""
+    clear_template_cache(request.args.get('event_type'))
+    return jsonify({'status': 'cleared'})
+
+
 # ==================== NOTIFICATIONS ENDPOINTS ====================
 
 @app.route('/notifications', methods=['GET'])
 def list_notifications():
-    """Get all notifications with optional filters."""
+    """Get notifications with optional filters, a page at a time (?before_id=<next_cursor>)."""
     try:
         status = request.args.get('status')
         target_erp = request.args.get('target_erp')
         event_type = request.args.get('event_type')
         limit = request.args.get('limit', 100, type=int)
+        before_id = request.args.get('before_id', type=int)
         
-        notifications = get_notifications(status, target_erp, event_type, limit)
+        notifications = get_notifications(status, target_erp, event_type, limit, before_id)
         
         return jsonify({
-            'notifications': [serialize_notification(n) for n in notifications],
-            'total': len(notifications)
+            'notifications': notifications,
+            'total': len(notifications),
+            # Pass back as before_id for the next page; null on the last page
+            'next_cursor': notifications[-1]['id'] if len(notifications) == limit else None
         })
     except Exception as e:
         logger.error(f"Error fetching notifications: {e}")
@@ -266,7 +364,7 @@ def get_notification(notification_id):
     try:
         notification = get_notification_by_id(notification_id)
         if notification:
-            return jsonify(serialize_notification(notification))
+            return jsonify(notification)
         return jsonify({'error': 'Notification not found'}), 404
     except Exception as e:
         logger.error(f"Error fetching notification: {e}")
@@ -293,7 +391,7 @@ def retry_notification(notification_id):
         updated = get_notification_by_id(notification_id)
         return jsonify({
             'success': success,
-            'notification': serialize_notification(updated)
+            'notification': updated
         })
     except Exception as e:
         logger.error(f"Error retrying notification: {e}")
@@ -316,18 +414,11 @@ def retry_pending():
     """Retry all pending/failed notifications."""
     try:
         pending = get_pending_notifications(50)
-        results = {'success': 0, 'failed': 0}
         
-        for notification in pending:
-            success = send_notification_to_erp(
-                notification['id'],
-                notification['target_erp'],
-                notification['payload']
-            )
-            if success:
-                results['success'] += 1
-            else:
-                results['failed'] += 1
+        outcomes = send_notifications(pending, RETRY_EXECUTOR)
+        
+        sent = sum(1 for outcome in outcomes if outcome[1] == 'sent')
+        results = {'success': sent, 'failed': len(outcomes) - sent}
         
         return jsonify({
             'processed': len(pending),
@@ -347,24 +438,25 @@ def send_test_notification():
         event_type = data.get('event_type', 'test.notification')
         target_erp = data.get('target_erp', 'ERP_WAGL')
         
-        notification = create_notification(
+        payload = data.get('payload', {'test': True})
+        notification_id = create_notification(
             event_type=event_type,
             event_id='test-001',
             source_service='manual',
             target_erp=target_erp,
-            payload=data.get('payload', {'test': True})
+            payload=payload
         )
         
         success = send_notification_to_erp(
-            notification['id'],
+            notification_id,
             target_erp,
-            notification['payload']
+            payload
         )
         
-        updated = get_notification_by_id(notification['id'])
+        updated = get_notification_by_id(notification_id)
         return jsonify({
             'success': success,
-            'notification': serialize_notification(updated)
+            'notification': updated
         }), 201
         
     except Exception as e:
@@ -372,15 +464,16 @@ def send_test_notification():
         return jsonify({'error': str(e)}), 500
 
 
-# Start Kafka consumer when app starts
-@app.before_request
-def ensure_kafka_consumer():
-    """Ensure Kafka consumer is running."""
-    start_kafka_consumer()
+def start_background_tasks():
+    """Start the Kafka consumer and partition maintenance of this process."""
+    watch_kafka_consumer()
+    maintain_partitions()
 
 
 if __name__ == '__main__':
     logger.info("Starting Notification Service on port 5003")
-    # Start Kafka consumer
-    start_kafka_consumer()
-    app.run(host='0.0.0.0', port=5003, debug=True, threaded=True)
+    debug = os.getenv('FLASK_ENV') == 'development'
+    # The reloader's parent process only watches files, it serves no requests
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_tasks()
+    app.run(host='0.0.0.0', port=5003, debug=debug, threaded=True)
@@ -0,0 +1,21 @@
+"""
+Gunicorn configuration for the Notification Service.
+"""
+import os
+
+bind = '0.0.0.0:5003'
+
+# Threaded workers: the Kafka consumer, its watchdog and the dispatch pools
+# run on plain threads next to the request handlers. Every worker joins the
+# same consumer group, so extra workers only take over idle partitions.
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+keepalive = 5
+timeout = 60
+
+
+def post_worker_init(worker):
+    """Start the Kafka consumer and partition maintenance in each worker."""
+    from app import start_background_tasks
+    start_background_tasks()
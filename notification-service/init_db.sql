@@ -1,13 +1,15 @@
 -- Notification Service Database Schema
 
--- Notifications log table
+-- Notifications log table, partitioned by month so tail reads only touch
+-- the newest partitions and old months can be dropped
 CREATE TABLE IF NOT EXISTS notifications (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     event_type VARCHAR(100) NOT NULL,
     event_id VARCHAR(100),
     source_service VARCHAR(100),
     target_erp VARCHAR(50) NOT NULL,
-    payload JSONB NOT NULL,
+    -- lz4 compresses large event payloads faster than the default pglz
+    payload JSONB COMPRESSION lz4 NOT NULL,
     status VARCHAR(50) DEFAULT 'pending',
     http_status_code INTEGER,
     response_body TEXT,
@@ -15,9 +17,44 @@ CREATE TABLE IF NOT EXISTS notifications (
     retry_count INTEGER DEFAULT 0,
     max_retries INTEGER DEFAULT 3,
     sent_at TIMESTAMP,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Creates the monthly partitions of `parent` from the current month to
+-- `months_ahead` months ahead; also run by the service periodically.
+-- A month whose rows already landed in the DEFAULT partition cannot get its
+-- own partition, so it is skipped with a warning and stays in DEFAULT.
+-- Old months are purged with DROP TABLE <parent>_<YYYY>_<MM>.
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(parent TEXT, months_ahead INTEGER DEFAULT 12)
+RETURNS VOID AS $$
+DECLARE
+    v_month TIMESTAMP;
+BEGIN
+    -- Every worker runs this, often at the same time
+    PERFORM pg_advisory_xact_lock(hashtext(parent));
+    FOR i IN 0..months_ahead LOOP
+        v_month := date_trunc('month', CURRENT_TIMESTAMP) + make_interval(months => i);
+        BEGIN
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                parent || '_' || to_char(v_month, 'YYYY_MM'),
+                parent,
+                v_month,
+                v_month + INTERVAL '1 month'
+            );
+        EXCEPTION WHEN check_violation THEN
+            RAISE WARNING 'Skipping partition %_%: its rows are already in the default partition',
+                parent, to_char(v_month, 'YYYY_MM');
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_monthly_partitions('notifications');
+-- Catches rows past the last monthly partition
+CREATE TABLE IF NOT EXISTS notifications_default PARTITION OF notifications DEFAULT;
 
 -- Notification templates table
 CREATE TABLE IF NOT EXISTS notification_templates (
@@ -31,10 +68,23 @@ CREATE TABLE IF NOT EXISTS notification_templates (
 );
 
 -- Indexes
-CREATE INDEX IF NOT EXISTS idx_notifications_status ON notifications(status);
-CREATE INDEX IF NOT EXISTS idx_notifications_event_type ON notifications(event_type);
-CREATE INDEX IF NOT EXISTS idx_notifications_target ON notifications(target_erp);
-CREATE INDEX IF NOT EXISTS idx_notifications_created ON notifications(created_at);
+-- Match the filters of the listing, already in its (created_at, id) DESC keyset order
+CREATE INDEX IF NOT EXISTS idx_notifications_status ON notifications(status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_event_type ON notifications(event_type, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_target ON notifications(target_erp, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_filters ON notifications(status, target_erp, event_type, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_created ON notifications(created_at DESC, id DESC);
+-- Today's sent count of the stats
+CREATE INDEX IF NOT EXISTS idx_notifications_sent_at ON notifications(sent_at) WHERE status = 'sent';
+
+-- Counts per status and target ERP for /notifications/stats, refreshed by
+-- get_notification_stats() once they are older than STATS_REFRESH_INTERVAL
+CREATE MATERIALIZED VIEW IF NOT EXISTS notification_stats_mv AS
+SELECT status, target_erp, COUNT(*) AS count, CURRENT_TIMESTAMP AS refreshed_at
+FROM notifications
+GROUP BY status, target_erp;
+-- Required by REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS idx_notification_stats_mv ON notification_stats_mv(status, target_erp);
 
 -- Insert notification templates
 INSERT INTO notification_templates (event_type, template_wagonlits, template_devmateriels, description, active) VALUES
@@ -1,16 +1,24 @@
 """
 Planning Service - Manages technician availability and inspection scheduling.
 """
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 from datetime import datetime, timedelta
+from itertools import chain, islice
+from decimal import Decimal
 import os
 import sys
+import atexit
 import json
 import logging
+import threading
+import orjson
 
 # Add shared folder to path
 sys.path.insert(0, '/app/shared')
 
+from kafka_utils import create_kafka_producer, publish_event_nowait
+
 from models import (
     get_all_technicians,
     get_technician_by_id,
@@ -21,68 +29,223 @@ from models import (
     schedule_inspection,
     schedule_inspection_by_slot,
     complete_inspection,
-    get_inspections_by_status,
-    get_slot_by_id
+    iter_inspections_by_status,
+    get_schedule_context,
+    NotFoundError,
+    SlotAlreadyBookedError,
+    InspectionNotPendingError,
+    SQL_STATEMENT_DEBUG,
+    reset_statement_count,
+    statement_count
 )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+def _default(value):
+    """Encode the values orjson does not handle natively."""
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson; dates, datetimes and times are encoded natively."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_default), mimetype='application/json')
 
-# Kafka producer (lazy initialization)
+
+app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Serve '/inspections/' and '/inspections' alike instead of answering with a redirect
+app.url_map.strict_slashes = False
+
+# Kafka producer (lazy initialization). Events are batched by the producer
+# and sent by its background thread instead of on the request thread.
+KAFKA_PRODUCER_CONFIG = {
+    'linger_ms': 20,
+    'batch_size': 64 * 1024,
+    'acks': 'all',
+    'compression_type': 'lz4'
+}
 kafka_producer = None
+_producer_lock = threading.Lock()
 
 def get_kafka_producer():
-    """Get or create Kafka producer."""
+    """Get or create Kafka producer; gunicorn creates it at worker start."""
     global kafka_producer
     if kafka_producer is None:
-        try:
-            from kafka_utils import create_kafka_producer
-            kafka_producer = create_kafka_producer()
-        except Exception as e:
-            logger.error(f"Failed to create Kafka producer: {e}")
+        with _producer_lock:
+            if kafka_producer is None:
+                try:
+                    kafka_producer = create_kafka_producer(**KAFKA_PRODUCER_CONFIG)
+                    atexit.register(kafka_producer.flush)
+                except Exception as e:
+                    logger.error(f"Failed to create Kafka producer: {e}")
     return kafka_producer
 
 
 def publish_event(topic, key, data):
-    """Publish event to Kafka."""
+    """Queue an event for Kafka without waiting for the broker acknowledgement."""
     try:
         producer = get_kafka_producer()
         if producer:
-            from kafka_utils import publish_event as kafka_publish
-            kafka_publish(producer, topic, key, data)
-            logger.info(f"Event published to {topic}")
+            publish_event_nowait(producer, topic, key, data)
+            logger.info(f"Event queued for {topic}")
         else:
             logger.warning("Kafka producer not available, event not published")
     except Exception as e:
         logger.error(f"Failed to publish event: {e}")
 
 
-def serialize_inspection(inspection):
-    """Serialize inspection for JSON response."""
-    if inspection is None:
+# Streamed listings are flushed to the client in chunks of about this size
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _stream_json_array(rows):
+    """
+    Stream rows as a JSON array without building the list in memory.
+    The first row is fetched before streaming starts so query errors still
+    produce an error response.
+    """
+    rows = iter(rows)
+    head = list(islice(rows, 1))
+
+    def generate():
+        buffer = bytearray(b'[')
+        total = 0
+        for row in chain(head, rows):
+            if total:
+                buffer += b','
+            buffer += orjson.dumps(row, default=_default)
+            total += 1
+            if len(buffer) >= STREAM_CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer += b']'
+        yield bytes(buffer)
+
+    return app.response_class(stream_with_context(generate()), mimetype='application/json')
+
+
+@app.after_request
+def add_etag(response):
+    """Tag successful GET responses so callers can revalidate with If-None-Match."""
+    if (request.method == 'GET' and response.status_code == 200
+            and not response.direct_passthrough and not response.is_streamed):
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+if SQL_STATEMENT_DEBUG:
+    # Handlers are expected to stay within this many statements per request
+    SQL_STATEMENT_BUDGET = int(os.getenv('SQL_STATEMENT_BUDGET', '3'))
+
+    @app.before_request
+    def start_statement_count():
+        reset_statement_count()
+
+    @app.after_request
+    def log_statement_count(response):
+        """Log the SQL statements a request issued, warning past SQL_STATEMENT_BUDGET."""
+        count = statement_count()
+        message = f"{request.method} {request.path} issued {count} SQL statements"
+        if count > SQL_STATEMENT_BUDGET:
+            logger.warning(f"{message} (budget {SQL_STATEMENT_BUDGET})")
+        else:
+            logger.info(message)
+        return response
+
+
+def _require(data, *fields):
+    """Return a 400 response naming the first missing field, or None when all are present."""
+    for field in fields:
+        if not data.get(field):
+            return jsonify({'error': f'{field} is required'}), 400
+    return None
+
+
+def _int_field(data, field):
+    """Return data[field] as an int, or None when it is not an integer."""
+    try:
+        return int(data[field])
+    except (TypeError, ValueError):
         return None
-    
-    result = dict(inspection)
-    for key, value in result.items():
-        if isinstance(value, datetime):
-            result[key] = value.isoformat()
-        elif isinstance(value, (bytes,)):
-            result[key] = value.decode('utf-8')
-    return result
+
+
+# ==================== EVENTS ====================
+# Dates and times are left as they come from the database; the producer
+# encodes them with orjson.
+
+def build_slot_scheduled_event(inspection, slot, technician):
+    """Build the inspection.scheduled event of an inspection booked on a slot."""
+    return {
+        'inspection_id': inspection['id'],
+        'wagon_id': inspection['wagon_id'],
+        'client_company': inspection['client_company'],
+        'scheduled_date': slot['slot_date'],
+        'start_time': slot['start_time'],
+        'end_time': slot['end_time'],
+        'location': inspection['location'],
+        'technician_id': technician['id'],
+        'technician_name': technician['name'],
+        'technician_specialty': technician['specialty'],
+        'status': 'scheduled',
+        'scheduled_at': datetime.now()
+    }
+
+
+def build_scheduled_event(inspection, technician):
+    """Build the inspection.scheduled event of an inspection scheduled at a given date."""
+    return {
+        'inspection_id': inspection['id'],
+        'wagon_id': inspection['wagon_id'],
+        'client_company': inspection['client_company'],
+        'scheduled_date': inspection['scheduled_date'],
+        'location': inspection['location'],
+        'technician_id': inspection['technician_id'],
+        'technician_name': technician['name'],
+        'status': 'scheduled'
+    }
+
+
+def build_completed_event(inspection, parts_needed):
+    """Build the inspection.completed event of a completed inspection."""
+    hours = inspection['estimated_repair_hours']
+    return {
+        'inspection_id': inspection['id'],
+        'wagon_id': inspection['wagon_id'],
+        'client_company': inspection['client_company'],
+        'findings': inspection['findings'],
+        'parts_needed': parts_needed,
+        # NUMERIC comes back as Decimal, which the Kafka serializer rejects
+        'estimated_repair_hours': float(hours) if hours is not None else None,
+        'status': 'completed',
+        'completed_at': datetime.now()
+    }
 
 
 # ==================== HEALTH CHECK ====================
 
-@app.route('/health', methods=['GET'])
+# Encoded once: liveness probes hit this endpoint many times per second
+HEALTH_BODY = b'{"status":"healthy","service":"planning-service"}'
+
+
+@app.route('/health', methods=['GET'], provide_automatic_options=False)
 def health_check():
     """Health check endpoint."""
-    return jsonify({
-        'status': 'healthy',
-        'service': 'planning-service'
-    })
+    # A fresh response each time, since add_etag() sets headers on it
+    return app.response_class(HEALTH_BODY, mimetype='application/json')
 
 
 # ==================== TECHNICIANS ====================
@@ -92,7 +255,7 @@ def list_technicians():
     """Get all technicians."""
     try:
         technicians = get_all_technicians()
-        return jsonify([dict(t) for t in technicians])
+        return jsonify(technicians)
     except Exception as e:
         logger.error(f"Error fetching technicians: {e}")
         return jsonify({'error': str(e)}), 500
@@ -115,11 +278,13 @@ def get_technician(technician_id):
 
 @app.route('/inspection/availability', methods=['GET'])
 def get_availability():
-    """Get available slots for inspection."""
+    """Get available slots for inspection, optionally a page at a time (?limit=&after_id=<next_cursor>)."""
     try:
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         specialty = request.args.get('specialty')
+        limit = request.args.get('limit', type=int)
+        after_id = request.args.get('after_id', type=int)
         
         if not start_date:
             start_date = datetime.now().date()
@@ -131,24 +296,14 @@ def get_availability():
         else:
             end_date = datetime.fromisoformat(end_date).date()
         
-        slots = get_available_slots(start_date, end_date, specialty)
-        
-        # Format for JSON response
-        result = []
-        for slot in slots:
-            result.append({
-                'slot_id': slot['id'],
-                'date': str(slot['slot_date']),
-                'start_time': str(slot['start_time']),
-                'end_time': str(slot['end_time']),
-                'technician_id': slot['technician_id'],
-                'technician_name': slot['technician_name'],
-                'specialty': slot['specialty']
-            })
+        # Dates and times are encoded by orjson as they come from the database
+        result = get_available_slots(start_date, end_date, specialty, limit, after_id)
         
         return jsonify({
             'available_slots': result,
             'total': len(result),
+            # Pass as after_id to get the next page
+            'next_cursor': result[-1]['slot_id'] if limit and len(result) == limit else None,
             'message': 'Sélectionnez un slot_id pour planifier votre inspection'
         })
     except Exception as e:
@@ -165,13 +320,12 @@ def request_inspection():
     Returns available slots with IDs for scheduling.
     """
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         
         # Validate required fields
-        if not data.get('wagon_id'):
-            return jsonify({'error': 'wagon_id is required'}), 400
-        if not data.get('client_company'):
-            return jsonify({'error': 'client_company is required'}), 400
+        error = _require(data, 'wagon_id', 'client_company')
+        if error:
+            return error
         
         # Create inspection
         inspection = create_inspection(data)
@@ -179,23 +333,10 @@ def request_inspection():
         # Get available slots for the next 14 days
         start_date = datetime.now().date()
         end_date = start_date + timedelta(days=14)
-        slots = get_available_slots(start_date, end_date)
-        
-        # Format available slots with IDs
-        available_slots = []
-        for slot in slots[:20]:  # Limit to 20 slots
-            available_slots.append({
-                'slot_id': slot['id'],
-                'date': str(slot['slot_date']),
-                'start_time': str(slot['start_time']),
-                'end_time': str(slot['end_time']),
-                'technician_id': slot['technician_id'],
-                'technician_name': slot['technician_name'],
-                'specialty': slot['specialty']
-            })
+        available_slots = get_available_slots(start_date, end_date, limit=20)
         
         response = {
-            'inspection': serialize_inspection(inspection),
+            'inspection': inspection,
             'available_slots': available_slots,
             'total_slots': len(available_slots),
             'message': 'Inspection créée. Sélectionnez un slot_id ci-dessous pour planifier.',
@@ -216,7 +357,7 @@ def get_inspection(inspection_id):
     try:
         inspection = get_inspection_by_id(inspection_id)
         if inspection:
-            return jsonify(serialize_inspection(inspection))
+            return jsonify(inspection)
         return jsonify({'error': 'Inspection not found'}), 404
     except Exception as e:
         logger.error(f"Error fetching inspection: {e}")
@@ -230,47 +371,58 @@ def schedule_by_slot(slot_id):
     Much simpler - just provide the slot_id and location.
     """
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         
         # Validate required fields
-        if not data.get('inspection_id'):
-            return jsonify({'error': 'inspection_id is required'}), 400
-        if not data.get('location'):
-            return jsonify({'error': 'location is required'}), 400
+        error = _require(data, 'inspection_id', 'location')
+        if error:
+            return error
         
-        inspection_id = data['inspection_id']
+        inspection_id = _int_field(data, 'inspection_id')
+        if inspection_id is None:
+            return jsonify({'error': 'inspection_id must be an integer'}), 400
         
-        # Verify inspection exists
-        existing = get_inspection_by_id(inspection_id)
-        if not existing:
+        # Verify inspection and slot in a single query
+        context = get_schedule_context(inspection_id, slot_id)
+        if context['inspection_id'] is None:
             return jsonify({'error': 'Inspection not found'}), 404
         
-        if existing['status'] != 'pending':
+        if context['inspection_status'] != 'pending':
             return jsonify({'error': 'Inspection is already scheduled or completed'}), 400
         
-        # Verify slot exists and is available
-        slot = get_slot_by_id(slot_id)
-        if not slot:
+        if context['slot_id'] is None:
             return jsonify({'error': 'Slot not found'}), 404
         
-        if slot['is_booked']:
+        if context['is_booked']:
             return jsonify({'error': 'Ce créneau est déjà réservé. Veuillez en choisir un autre.'}), 400
         
-        # Get technician info
-        technician = get_technician_by_id(slot['technician_id'])
+        # Book the slot; a concurrent booking is still caught by the same statement
+        try:
+            inspection, slot = schedule_inspection_by_slot(
+                inspection_id,
+                slot_id,
+                data['location']
+            )
+        except NotFoundError as e:
+            return jsonify({'error': str(e)}), 404
+        except InspectionNotPendingError as e:
+            return jsonify({'error': str(e)}), 400
+        except SlotAlreadyBookedError:
+            return jsonify({'error': 'Ce créneau est déjà réservé. Veuillez en choisir un autre.'}), 400
         
-        # Schedule the inspection
-        inspection = schedule_inspection_by_slot(
-            inspection_id,
-            slot_id,
-            data['location']
-        )
+        technician = {
+            'id': context['technician_id'],
+            'name': context['technician_name'],
+            'specialty': context['specialty'],
+            'phone': context['phone'],
+            'email': context['email']
+        }
         
         # Build confirmation response
         confirmation = {
             'status': 'confirmed',
             'message': 'Inspection planifiée avec succès!',
-            'inspection': serialize_inspection(inspection),
+            'inspection': inspection,
             'schedule_details': {
                 'date': str(slot['slot_date']),
                 'start_time': str(slot['start_time']),
@@ -292,21 +444,10 @@ def schedule_by_slot(slot_id):
         }
         
         # Publish event to Kafka
-        event_data = {
-            'inspection_id': inspection['id'],
-            'wagon_id': inspection['wagon_id'],
-            'client_company': inspection['client_company'],
-            'scheduled_date': str(slot['slot_date']),
-            'start_time': str(slot['start_time']),
-            'end_time': str(slot['end_time']),
-            'location': inspection['location'],
-            'technician_id': technician['id'],
-            'technician_name': technician['name'],
-            'technician_specialty': technician['specialty'],
-            'status': 'scheduled',
-            'scheduled_at': datetime.now().isoformat()
-        }
-        publish_event('inspection.scheduled', str(inspection['id']), event_data)
+        publish_event(
+            'inspection.scheduled', str(inspection['id']),
+            build_slot_scheduled_event(inspection, slot, technician)
+        )
         
         logger.info(f"Inspection {inspection_id} scheduled via slot {slot_id}")
         return jsonify(confirmation), 200
@@ -320,15 +461,21 @@ def schedule_by_slot(slot_id):
 def schedule_inspection_endpoint(inspection_id):
     """Schedule an inspection with a specific date and technician (legacy method)."""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         
         # Validate required fields
-        if not data.get('scheduled_date'):
-            return jsonify({'error': 'scheduled_date is required'}), 400
-        if not data.get('location'):
-            return jsonify({'error': 'location is required'}), 400
-        if not data.get('technician_id'):
-            return jsonify({'error': 'technician_id is required'}), 400
+        error = _require(data, 'scheduled_date', 'location', 'technician_id')
+        if error:
+            return error
+        
+        technician_id = _int_field(data, 'technician_id')
+        if technician_id is None:
+            return jsonify({'error': 'technician_id must be an integer'}), 400
+        
+        try:
+            scheduled_date = datetime.fromisoformat(str(data['scheduled_date']).replace('Z', '+00:00'))
+        except ValueError:
+            return jsonify({'error': 'scheduled_date must be an ISO 8601 date'}), 400
         
         # Verify inspection exists
         existing = get_inspection_by_id(inspection_id)
@@ -336,33 +483,29 @@ def schedule_inspection_endpoint(inspection_id):
             return jsonify({'error': 'Inspection not found'}), 404
         
         # Verify technician exists
-        technician = get_technician_by_id(data['technician_id'])
+        technician = get_technician_by_id(technician_id)
         if not technician:
             return jsonify({'error': 'Technician not found'}), 404
         
         # Schedule the inspection
-        inspection = schedule_inspection(
-            inspection_id,
-            data['scheduled_date'],
-            data['location'],
-            data['technician_id']
-        )
+        try:
+            inspection = schedule_inspection(
+                inspection_id,
+                scheduled_date,
+                data['location'],
+                technician_id
+            )
+        except (SlotAlreadyBookedError, InspectionNotPendingError) as e:
+            return jsonify({'error': str(e)}), 400
         
         # Publish event to Kafka
-        event_data = {
-            'inspection_id': inspection['id'],
-            'wagon_id': inspection['wagon_id'],
-            'client_company': inspection['client_company'],
-            'scheduled_date': str(inspection['scheduled_date']),
-            'location': inspection['location'],
-            'technician_id': inspection['technician_id'],
-            'technician_name': technician['name'],
-            'status': 'scheduled'
-        }
-        publish_event('inspection.scheduled', str(inspection['id']), event_data)
+        publish_event(
+            'inspection.scheduled', str(inspection['id']),
+            build_scheduled_event(inspection, technician)
+        )
         
         logger.info(f"Inspection {inspection_id} scheduled for {data['scheduled_date']}")
-        return jsonify(serialize_inspection(inspection))
+        return jsonify(inspection)
         
     except Exception as e:
         logger.error(f"Error scheduling inspection: {e}")
@@ -373,11 +516,12 @@ def schedule_inspection_endpoint(inspection_id):
 def complete_inspection_endpoint(inspection_id):
     """Complete an inspection with findings and parts needed."""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         
         # Validate required fields
-        if not data.get('findings'):
-            return jsonify({'error': 'findings is required'}), 400
+        error = _require(data, 'findings')
+        if error:
+            return error
         
         # Verify inspection exists
         existing = get_inspection_by_id(inspection_id)
@@ -396,20 +540,13 @@ def complete_inspection_endpoint(inspection_id):
         )
         
         # Publish event to Kafka
-        event_data = {
-            'inspection_id': inspection['id'],
-            'wagon_id': inspection['wagon_id'],
-            'client_company': inspection['client_company'],
-            'findings': inspection['findings'],
-            'parts_needed': data.get('parts_needed', []),
-            'estimated_repair_hours': inspection['estimated_repair_hours'],
-            'status': 'completed',
-            'completed_at': datetime.now().isoformat()
-        }
-        publish_event('inspection.completed', str(inspection['id']), event_data)
+        publish_event(
+            'inspection.completed', str(inspection['id']),
+            build_completed_event(inspection, data.get('parts_needed', []))
+        )
         
         logger.info(f"Inspection {inspection_id} completed")
-        return jsonify(serialize_inspection(inspection))
+        return jsonify(inspection)
         
     except Exception as e:
         logger.error(f"Error completing inspection: {e}")
@@ -418,13 +555,12 @@ def complete_inspection_endpoint(inspection_id):
 
 @app.route('/inspections', methods=['GET'])
 def list_inspections():
-    """List inspections with optional filters."""
+    """List inspections with optional filters, streamed from a server-side cursor."""
     try:
         status = request.args.get('status')
         client = request.args.get('client_company')
         
-        inspections = get_inspections_by_status(status, client)
-        return jsonify([serialize_inspection(i) for i in inspections])
+        return _stream_json_array(iter_inspections_by_status(status, client))
     except Exception as e:
         logger.error(f"Error listing inspections: {e}")
         return jsonify({'error': str(e)}), 500
@@ -432,4 +568,4 @@ def list_inspections():
 
 if __name__ == '__main__':
     logger.info("Starting Planning Service on port 5001")
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    app.run(host='0.0.0.0', port=5001, debug=os.getenv('FLASK_ENV') == 'development')
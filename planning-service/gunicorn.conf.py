@@ -0,0 +1,31 @@
+"""
+Gunicorn configuration for the Planning Service.
+"""
+import multiprocessing
+import os
+
+bind = '0.0.0.0:5001'
+
+# gevent workers overlap database and Kafka waits across requests
+worker_class = 'gevent'
+workers = int(os.getenv('GUNICORN_WORKERS', min(multiprocessing.cpu_count(), 4)))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+keepalive = 5
+timeout = 60
+
+
+def post_fork(server, worker):
+    """Make psycopg2 yield to other greenlets while waiting on PostgreSQL."""
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def post_worker_init(worker):
+    """Connect to Kafka and load the technicians cache before the worker takes requests."""
+    from app import get_kafka_producer
+    from models import get_all_technicians
+    get_kafka_producer()
+    try:
+        get_all_technicians()
+    except Exception as e:
+        worker.log.warning(f"Could not warm the technicians cache: {e}")
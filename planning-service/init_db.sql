@@ -48,6 +48,11 @@ CREATE INDEX IF NOT EXISTS idx_inspections_status ON inspections(status);
 CREATE INDEX IF NOT EXISTS idx_inspections_wagon_id ON inspections(wagon_id);
 CREATE INDEX IF NOT EXISTS idx_availability_date ON availability_slots(slot_date);
 CREATE INDEX IF NOT EXISTS idx_availability_technician ON availability_slots(technician_id);
+-- Open slots in listing order, so availability is read without sorting
+CREATE INDEX IF NOT EXISTS idx_availability_open ON availability_slots(slot_date, start_time, id) WHERE is_booked = false;
+CREATE INDEX IF NOT EXISTS idx_technicians_available ON technicians(id) WHERE is_available = true;
+-- An inspection holds at most one booked slot, whatever the booking path
+CREATE UNIQUE INDEX IF NOT EXISTS idx_availability_booked_inspection ON availability_slots(inspection_id) WHERE is_booked = true;
 
 -- Insert sample technicians
 INSERT INTO technicians (name, email, phone, specialty, is_available) VALUES
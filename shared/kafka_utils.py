@@ -1,8 +1,8 @@
 """
 Kafka utilities for microservices communication.
 """
-import json
 import os
+import orjson
 from kafka import KafkaProducer, KafkaConsumer
 from kafka.errors import NoBrokersAvailable
 import time
@@ -24,18 +24,24 @@ TOPICS = {
 }
 
 
-def create_kafka_producer(retries=5, retry_delay=5):
+def create_kafka_producer(retries=5, retry_delay=5, **config):
     """
     Create a Kafka producer with retry logic.
+    Extra keyword arguments override the default KafkaProducer settings.
     """
+    settings = {
+        'acks': 'all',
+        'retries': 3,
+        'compression_type': 'lz4',
+        'value_serializer': orjson.dumps,
+        'key_serializer': lambda k: k.encode('utf-8') if k else None,
+        **config
+    }
     for attempt in range(retries):
         try:
             producer = KafkaProducer(
                 bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS.split(','),
-                value_serializer=lambda v: json.dumps(v).encode('utf-8'),
-                key_serializer=lambda k: k.encode('utf-8') if k else None,
-                acks='all',
-                retries=3
+                **settings
             )
             logger.info(f"Kafka producer connected to {KAFKA_BOOTSTRAP_SERVERS}")
             return producer
@@ -46,19 +52,24 @@ def create_kafka_producer(retries=5, retry_delay=5):
     raise Exception("Failed to connect to Kafka after multiple attempts")
 
 
-def create_kafka_consumer(topics, group_id, retries=5, retry_delay=5):
+def create_kafka_consumer(topics, group_id, retries=5, retry_delay=5, **config):
     """
     Create a Kafka consumer with retry logic.
+    Extra keyword arguments override the default KafkaConsumer settings.
     """
+    settings = {
+        'value_deserializer': orjson.loads,
+        'auto_offset_reset': 'earliest',
+        'enable_auto_commit': True,
+        **config
+    }
     for attempt in range(retries):
         try:
             consumer = KafkaConsumer(
                 *topics,
                 bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS.split(','),
                 group_id=group_id,
-                value_deserializer=lambda v: json.loads(v.decode('utf-8')),
-                auto_offset_reset='earliest',
-                enable_auto_commit=True
+                **settings
             )
             logger.info(f"Kafka consumer connected to {KAFKA_BOOTSTRAP_SERVERS}")
             return consumer
@@ -81,3 +92,13 @@ def publish_event(producer, topic, key, data):
     except Exception as e:
         logger.error(f"Failed to publish event to {topic}: {e}")
         raise
+
+
+def publish_event_nowait(producer, topic, key, data):
+    """
+    Queue an event for a Kafka topic without waiting for the broker.
+    The producer batches queued events; delivery failures are logged.
+    """
+    future = producer.send(topic, key=key, value=data)
+    future.add_errback(lambda e: logger.error(f"Failed to publish event to {topic}: {e}"))
+    return future